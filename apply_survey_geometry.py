@@ -13,6 +13,8 @@ import desimodel.footprint as foot
 import desimodel.io
 import h5py
 
+from shell_store import ShellFilters, ShellStore
+
 
 def bits(ask="try"):
     "Used"
@@ -76,6 +78,8 @@ class SurveyGeometry():
         self.box_length =  config.getint('sim', 'box_length')
         self.zmin       =  config.getfloat('sim', 'zmin')
         self.zmax       =  config.getfloat('sim', 'zmax')
+        self.shell_filters = ShellFilters.from_config(config)
+        self.shell_layout  = config.get('sim', 'shell_layout', fallback='files')
 
         self.galtype = galtype
 
@@ -154,21 +158,18 @@ class SurveyGeometry():
         return outbits, ran
         
 
-    def generate_shell(self, args):
-        infile, footprint_mask, todo = args
-        print(f"INFO: Read {infile}")
-
-        f = h5py.File(infile, 'r+')
-        n_mean = f.attrs["NGAL"] / (f.attrs["BOX_LENGTH"]**3)
+    def shell_columns(self, shell):
+        """ STATUS and RAN_NUM_0_1 (and RAN_NUM_0_1_LOP for ELGs) of a shell file, or of the group of a shell in the store """
+        n_mean = shell.attrs["NGAL"] / (shell.attrs["BOX_LENGTH"]**3)
 
-        shellnum = f.attrs["SHELLNUM"]
-        cat_seed = f.attrs["CAT_SEED"]
+        shellnum = shell.attrs["SHELLNUM"]
+        cat_seed = shell.attrs["CAT_SEED"]
 
         unique_seed = self.tracer_id * 500500 + 250 * cat_seed + shellnum
         print("INFO: UNIQUE SEED:", unique_seed, flush=True)
         np.random.seed(unique_seed)
 
-        data = f['galaxy']
+        data = shell['galaxy']
         ra = data['RA'][()]
         dec = data['DEC'][()]
         z_cosmo = data['Z_COSMO'][()]
@@ -178,23 +179,60 @@ class SurveyGeometry():
         down_bit, ran_arr = self.downsample(z_cosmo, n_mean)
 
         out_arr = np.bitwise_or(np.bitwise_or(foot_bit_0, foot_bit_1), down_bit)
-        out_arr = out_arr.astype(np.int32)
+        columns = {"STATUS": out_arr.astype(np.int32), "RAN_NUM_0_1": ran_arr[0].astype(np.float32)}
+        if self.galtype == "ELG":
+            columns["RAN_NUM_0_1_LOP"] = ran_arr[1].astype(np.float32)
+        return columns
+
+    def add_columns(self, shell, columns):
+        """ writes the new columns into the galaxy group of shell, keeping the existing ones """
+        data = shell['galaxy']
+        options = self.shell_filters.options(len(columns["STATUS"]))
 
         if "STATUS" in data.keys():
             print("WARNING: STATUS EXISTS. New STATUS has not been written.")
         else:
-            f.create_dataset('galaxy/STATUS', data=out_arr,  dtype=np.int32)
+            data.create_dataset('STATUS', data=columns["STATUS"], dtype=np.int32, **options)
 
         if "RAN_NUM_0_1" in data.keys():
             print("WARNING: RAN_NUM_0_1 EXISTS. New RAN_NUM_0_1 has not been written.")
         else:
-            f.create_dataset('galaxy/RAN_NUM_0_1', data=ran_arr[0], dtype=np.float32)
-            if self.galtype == "ELG":
-                f.create_dataset('galaxy/RAN_NUM_0_1_LOP', data=ran_arr[1], dtype=np.float32)
+            data.create_dataset('RAN_NUM_0_1', data=columns["RAN_NUM_0_1"], dtype=np.float32, **options)
+            if "RAN_NUM_0_1_LOP" in columns:
+                data.create_dataset('RAN_NUM_0_1_LOP', data=columns["RAN_NUM_0_1_LOP"], dtype=np.float32, **options)
+
+    def generate_shell(self, args):
+        infile, footprint_mask, todo = args
+        print(f"INFO: Read {infile}")
 
+        f = h5py.File(infile, 'r+')
+        self.add_columns(f, self.shell_columns(f))
         f.close()
 
+    def store_shell_columns(self, args):
+        """ reads a shell of the store, under its shared lock, and returns its new columns to the writer """
+        store_file, shellnum, footprint_mask, todo = args
+        print(f"INFO: Read {store_file}:{ShellStore.group(shellnum)}")
+
+        with ShellStore(store_file).open("r") as f:
+            columns = self.shell_columns(f[ShellStore.group(shellnum)])
+        return shellnum, columns
+
+    def store_shells(self, path_instance, nproc, footprint_mask, todo):
+        """ the shells of the store are read and processed by nproc processes and written one at a time by this one """
+        store = ShellStore(path_instance.store_file)
+        shellnums = sorted(store.shellnums())
+        args = product([store.filename], shellnums, [footprint_mask], [todo])
+
+        with mp.Pool(processes=max(1, min(nproc, len(shellnums)))) as pool:
+            for shellnum, columns in pool.imap_unordered(self.store_shell_columns, args):
+                with store.open("a") as f:
+                    self.add_columns(f[ShellStore.group(shellnum)], columns)
+
     def shell(self, path_instance, nproc=5, footprint_mask=0, todo=1):
+        if self.shell_layout == "store":
+            self.store_shells(path_instance, nproc, footprint_mask, todo)
+            return
 
         infiles = glob.glob(path_instance.shells_out_path + "/*.hdf5")
 
@@ -210,6 +248,9 @@ class SurveyGeometry():
             pool.join()
 
     def shell_series(self, path_instance, footprint_mask=0, todo=1):
+        if self.shell_layout == "store":
+            self.store_shells(path_instance, 1, footprint_mask, todo)
+            return
 
         infiles = glob.glob(path_instance.shells_out_path + "/*.hdf5")
         print(infiles)
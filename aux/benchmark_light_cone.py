@@ -0,0 +1,658 @@
+import sys
+import os
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from generate_light_cone import ShellAccumulator, xyz2rd
+from cosmology import DistanceTable
+
+
+def timeit(func, repeat=3):
+    best = np.inf
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def synthetic_box(ngal, box_length, seed=42):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0, box_length, size=(3, ngal))
+
+
+def tile_selections(pos, box_length, chilow, chiupp):
+    """ per-tile (ra, dec, z, aux) selections of a synthetic shell """
+    px, py, pz = pos
+    ntiles = int(np.ceil(chiupp / box_length))
+    selections = []
+    for xx in range(-ntiles, ntiles):
+        for yy in range(-ntiles, ntiles):
+            for zz in range(-ntiles, ntiles):
+                sx = px + box_length * xx
+                sy = py + box_length * yy
+                sz = pz + box_length * zz
+                r = np.sqrt(sx * sx + sy * sy + sz * sz)
+                idx = np.where((r > chilow) & (r < chiupp))[0]
+                if idx.size != 0:
+                    selections.append((sx[idx], sy[idx], r[idx], r[idx]))
+    return selections, (2 * ntiles)**3
+
+
+def bench_accumulator(args):
+    pos = synthetic_box(args.ngal, args.box_length)
+    selections, ntiles = tile_selections(pos, args.box_length, args.chilow, args.chiupp)
+    nsel = sum(len(s[0]) for s in selections)
+    print(f"INFO: {ntiles} tiles, {len(selections)} hit the shell, {nsel} selected objects")
+
+    def with_append():
+        totra, totdec, totz, tot_aux = np.array([]), np.array([]), np.array([]), np.array([])
+        for ra, dec, zz, aux in selections:
+            totra   = np.append(totra, ra)
+            totdec  = np.append(totdec, dec)
+            totz    = np.append(totz, zz)
+            tot_aux = np.append(tot_aux, aux)
+        return totra, totdec, totz, tot_aux
+
+    def with_accumulator():
+        accumulator = ShellAccumulator()
+        for ra, dec, zz, aux in selections:
+            accumulator.append(ra, dec, zz, aux)
+        return accumulator.assemble()
+
+    for a, b in zip(with_append(), with_accumulator()):
+        assert np.array_equal(a, b)
+
+    t_append = timeit(with_append, args.repeat)
+    t_accumulator = timeit(with_accumulator, args.repeat)
+    print(f"np.append:        {t_append:.4f} s")
+    print(f"ShellAccumulator: {t_accumulator:.4f} s")
+    print(f"speedup:          {t_append / t_accumulator:.1f}x")
+
+
+def bench_distance_table(args):
+    import camb
+
+    pars = camb.read_ini(args.file_camb)
+    h = pars.h
+    results = camb.get_background(pars)
+
+    chi_max = results.comoving_radial_distance(args.zmax) * h
+    start = time.perf_counter()
+    table = DistanceTable.from_camb(results, h, chi_max, tol=args.tol)
+    print(f"INFO: table built in {time.perf_counter() - start:.3f} s")
+
+    rng = np.random.default_rng(0)
+    chi = rng.uniform(0, chi_max, size=args.nlookup)
+
+    z_camb = results.redshift_at_comoving_radial_distance(chi / h)
+    z_table = table.redshift(chi)
+    print(f"max |z_table - z_camb| = {np.max(np.abs(z_table - z_camb)):.2e} (tol={args.tol:.0e})")
+
+    t_camb = timeit(lambda: results.redshift_at_comoving_radial_distance(chi / h), args.repeat)
+    t_table = timeit(lambda: table.redshift(chi), args.repeat)
+    print(f"CAMB:          {args.nlookup / t_camb:.3e} lookups/s")
+    print(f"DistanceTable: {args.nlookup / t_table:.3e} lookups/s")
+    print(f"speedup:       {t_camb / t_table:.1f}x")
+
+
+def bench_angles(args):
+    import healpy as hp
+
+    rng = np.random.default_rng(0)
+    sx, sy, sz = rng.uniform(-args.chi, args.chi, size=(3, args.ngal)).astype(args.dtype)
+    r = np.sqrt(sx * sx + sy * sy + sz * sz)
+
+    def with_healpy():
+        ux, uy, uz = sx / r, sy / r, sz / r
+        tht, phi = hp.vec2ang(np.c_[ux, uy, uz])
+        return phi / np.pi * 180.0, -1 * (tht / np.pi * 180.0 - 90.0)
+
+    def with_kernel():
+        return xyz2rd(sx, sy, sz)
+
+    ### Reference in double precision from the same inputs
+    x, y, z = sx.astype(np.float64), sy.astype(np.float64), sz.astype(np.float64)
+    ra_ref  = np.degrees(np.arctan2(y, x)) % 360.0
+    dec_ref = np.degrees(np.arctan2(z, np.hypot(x, y)))
+    for name, func in (("healpy", with_healpy), ("xyz2rd", with_kernel)):
+        ra, dec = func()
+        dra = np.abs(ra - ra_ref)
+        dra = np.minimum(dra, 360.0 - dra)
+        print(f"{name}: max |dRA| = {dra.max():.2e} deg, max |dDEC| = {np.abs(dec - dec_ref).max():.2e} deg")
+
+    t_healpy = timeit(with_healpy, args.repeat)
+    t_kernel = timeit(with_kernel, args.repeat)
+    print(f"vec2ang + tp2rd: {args.ngal / t_healpy:.3e} objects/s")
+    print(f"xyz2rd:          {args.ngal / t_kernel:.3e} objects/s")
+    print(f"speedup:         {t_healpy / t_kernel:.1f}x")
+
+
+def make_lightcone(config, mock_random_ic="mock"):
+    from generate_light_cone import LightCone
+
+    lc_args = argparse.Namespace(dir_out=None, dir_in=None, mock_random_ic=mock_random_ic, ngc_sgc=None)
+    return LightCone(config, lc_args)
+
+
+def synthetic_subbox(ngal, box_length, seed=0):
+    """ subbox table with the columns and FITS types of the mock, random and ic inputs """
+    rng = np.random.default_rng(seed)
+    data = np.zeros(ngal, dtype=[(col, ">f4") for col in ("x", "y", "z", "vx", "vy", "vz", "density")] + [("id", ">i4")])
+    for col in ("x", "y", "z"):
+        data[col] = rng.uniform(0, box_length, size=ngal)
+    for col in ("vx", "vy", "vz"):
+        data[col] = rng.normal(0, 300, size=ngal)
+    data["density"] = rng.lognormal(0, 1, size=ngal) - 1
+    data["id"] = np.arange(ngal)
+    return data
+
+
+def bench_float32(args):
+    """ precision and peak memory of the float32 compute mode on a single shell of a synthetic box """
+    import copy
+    import tracemalloc
+
+    lc64 = make_lightcone(args.config)
+    lc64.float32 = False
+    lc32 = copy.copy(lc64)
+    lc32.float32 = True
+
+    shellnum = int(lc64.distances.comoving_distance(args.z) // lc64.shellwidth)
+    chilow = lc64.shellwidth * (shellnum + 0)
+    chiupp = lc64.shellwidth * (shellnum + 1)
+
+    data = synthetic_subbox(args.ngal, lc64.box_length)
+
+    ### Drop the objects that lie within eps of the shell edges in any replica, so that
+    ### both modes select the same objects and the outputs can be compared one to one
+    matrix = np.reshape(lc64.rotation_matrix, (3, 3)) if lc64.rotate else np.eye(3)
+    pos = np.stack([data[col].astype(np.float64) for col in ("x", "y", "z")])
+    keep = np.ones(args.ngal, dtype=bool)
+    for tile in lc64.replicas(chilow, chiupp)[0]:
+        r = np.sqrt(np.sum((matrix @ (pos + lc64.box_length * tile[:, None]))**2, axis=0))
+        keep &= (np.abs(r - chilow) > args.eps) & (np.abs(r - chiupp) > args.eps)
+    data = data[keep]
+    print(f"INFO: shell [{chilow}, {chiupp}] Mpc/h in a {lc64.box_length} Mpc/h box, {len(data)} objects")
+
+    outputs = {}
+    for name, lc in (("float64", lc64), ("float32", lc32)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        outputs[name] = lc.convert_xyz2rdz(data, "", chilow, chiupp)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{name}: {elapsed:.3f} s, peak memory {peak / 2**20:.1f} MiB, {len(outputs[name][0])} objects")
+
+    ra64, dec64, z64, zrsd64 = outputs["float64"][:4]
+    ra32, dec32, z32, zrsd32 = outputs["float32"][:4]
+    dra = np.abs(ra32 - ra64)
+    dra = np.minimum(dra, 360.0 - dra)
+    print(f"max |dRA|    = {dra.max():.2e} deg")
+    print(f"max |dDEC|   = {np.abs(dec32 - dec64).max():.2e} deg")
+    print(f"max |dZ|     = {np.abs(z32 - z64).max():.2e}")
+    print(f"max |dZ_RSD| = {np.abs(zrsd32 - zrsd64).max():.2e}")
+
+
+def bench_fused(args):
+    """ numexpr reference vs the fused numba kernel, for the three aux modes, with and without the rotation """
+    import copy
+
+    for mode in ("mock", "random", "ic"):
+        lc_ne = make_lightcone(args.config, mock_random_ic=mode)
+        lc_ne.backend = "numexpr"
+        lc_nb = copy.copy(lc_ne)
+        lc_nb.backend = "numba"
+        lc_nb.fused_tile_selections(lc_nb.warmup_data(), np.zeros((1, 3)), 0, 1)
+
+        data = synthetic_subbox(args.ngal, lc_ne.box_length)
+        chilow, chiupp = args.chilow, args.chiupp
+
+        for rotate in (True, False):
+            lc_ne.rotate = lc_nb.rotate = rotate
+            out_ne = lc_ne.convert_xyz2rdz(data, "", chilow, chiupp)
+            out_nb = lc_nb.convert_xyz2rdz(data, "", chilow, chiupp)
+            same = len(out_ne[0]) == len(out_nb[0])
+            print(f"{mode}, rotate {rotate}: {len(out_ne[0])} (numexpr) and {len(out_nb[0])} (numba) objects, same count: {same}")
+            if same:
+                for name, a, b in zip(("RA", "DEC", "Z", "AUX"), out_ne[:4], out_nb[:4]):
+                    print(f"    max |d{name}| = {np.max(np.abs(a.astype(np.float64) - b.astype(np.float64)), initial=0):.2e}")
+
+            t_ne = timeit(lambda: lc_ne.convert_xyz2rdz(data, "", chilow, chiupp), args.repeat)
+            t_nb = timeit(lambda: lc_nb.convert_xyz2rdz(data, "", chilow, chiupp), args.repeat)
+            print(f"    numexpr: {t_ne:.3f} s, numba: {t_nb:.3f} s, speedup: {t_ne / t_nb:.1f}x")
+
+
+def bench_replicas(args):
+    """ runtime of a shell against the box size at fixed number density: replica by replica vs batched replicas """
+    import copy
+
+    lc = make_lightcone(args.config)
+    chilow, chiupp = args.chilow, args.chiupp
+    for box_length in args.box_lengths:
+        lc.box_length = box_length
+        ngal = int(args.density * box_length**3)
+        data = synthetic_subbox(ngal, box_length)
+        tiles, ntotal = lc.replicas(chilow, chiupp, extent=lc.data_extent(data))
+
+        lc_single = copy.copy(lc)
+        lc_single.replica_batch = 1
+        out_single = lc_single.convert_xyz2rdz(data, "", chilow, chiupp)
+        out_batch  = lc.convert_xyz2rdz(data, "", chilow, chiupp)
+        same = all(np.array_equal(a, b) for a, b in zip(out_single[:4], out_batch[:4]))
+
+        t_single = timeit(lambda: lc_single.convert_xyz2rdz(data, "", chilow, chiupp), args.repeat)
+        t_batch  = timeit(lambda: lc.convert_xyz2rdz(data, "", chilow, chiupp), args.repeat)
+        print(f"box {box_length:6.0f} Mpc/h: {ngal:9d} objects, {len(tiles):5d} of {ntotal:6d} replicas, {len(out_batch[0]):8d} selected, "
+              f"per replica {t_single:.3f} s, batched {t_batch:.3f} s, speedup {t_single / t_batch:.1f}x, identical: {same}")
+
+
+def bench_cell_index(args):
+    """ brute force vs cell index selection, for several shell widths """
+    import copy
+    from generate_light_cone import CellIndex
+
+    lc_brute = make_lightcone(args.config)
+    lc_brute.cell_size = 0
+    lc_index = copy.copy(lc_brute)
+    lc_index.cell_size = args.cell_size
+
+    data = synthetic_subbox(args.ngal, lc_brute.box_length)
+    extent = lc_brute.data_extent(data)
+    t_build = timeit(lambda: CellIndex(data, extent, args.cell_size), args.repeat)
+    print(f"INFO: {args.ngal} objects in a {lc_brute.box_length} Mpc/h box, cells of {args.cell_size} Mpc/h, index built in {t_build:.3f} s")
+
+    for width in args.widths:
+        chilow, chiupp = args.chilow, args.chilow + width
+        tiles = lc_brute.replicas(chilow, chiupp, extent=extent)[0]
+        out_brute = lc_brute.convert_xyz2rdz(data, "", chilow, chiupp)
+        out_index = lc_index.convert_xyz2rdz(data, "", chilow, chiupp)
+        same = all(np.array_equal(a, b) for a, b in zip(out_brute[:4], out_index[:4]))
+
+        index = CellIndex(data, extent, args.cell_size)
+        for shift in lc_brute.box_length * tiles - np.asarray(lc_brute.origin):
+            index.candidates(shift, chilow, chiupp)
+        nsel = len(out_brute[0])
+        npairs = len(tiles) * args.ngal
+
+        t_brute = timeit(lambda: lc_brute.convert_xyz2rdz(data, "", chilow, chiupp), args.repeat)
+        t_index = timeit(lambda: lc_index.convert_xyz2rdz(data, "", chilow, chiupp), args.repeat)
+        print(f"shell width {width:5.0f} Mpc/h: {nsel} selected, selection rate {nsel / npairs:.2%} (brute force) "
+              f"vs {nsel / max(index.visited, 1):.2%} (cell index), brute force {t_brute:.3f} s, cell index {t_index:.3f} s, "
+              f"speedup {t_brute / t_index:.1f}x, identical: {same}")
+
+
+def bench_chunks(args):
+    """ peak memory and runtime of a shell for a subbox FITS file read whole or in chunks """
+    import tempfile
+    import tracemalloc
+    from astropy.io import fits
+
+    lc = make_lightcone(args.config)
+    data = synthetic_subbox(args.ngal, lc.box_length)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        infile = os.path.join(tmpdir, "subbox.fits")
+        fits.BinTableHDU(data).writeto(infile)
+        del data
+
+        reference = None
+        for chunk_size in args.chunk_sizes:
+            lc.chunk_size = chunk_size
+            tracemalloc.start()
+            start = time.perf_counter()
+            accumulator, ngalbox = lc.accumulate_shell(lc.obtain_data(infile, ""), "", args.chilow, args.chiupp)
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            output = accumulator.assemble()
+            reference = reference or output
+            same = all(np.array_equal(a, b) for a, b in zip(reference, output))
+            print(f"chunk size {chunk_size:9d}: {elapsed:.3f} s, peak memory {peak / 2**20:7.1f} MiB, {len(output[0])} objects, identical: {same}")
+
+
+def bench_loader(args):
+    """ load time of a subbox (.fits and .fits.gz) with astropy, fitsio and obtain_data, and the transform time on each """
+    import gzip
+    import shutil
+    import tempfile
+    import fitsio
+    from astropy.io import fits
+
+    lc = make_lightcone(args.config)
+    columns = lc.columns()
+    data = synthetic_subbox(args.ngal, lc.box_length)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        infile = os.path.join(tmpdir, "subbox.fits")
+        fits.BinTableHDU(data).writeto(infile)
+        with open(infile, "rb") as f_in, gzip.open(infile + ".gz", "wb", compresslevel=1) as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        del data
+
+        def load_astropy(filename):
+            with fits.open(filename, memmap=False) as hdul:
+                return hdul[1].data
+
+        loaders = (("astropy, whole table", load_astropy),
+                   ("fitsio, needed columns", lambda filename: fitsio.read(filename, ext=1, columns=columns)),
+                   ("obtain_data", lambda filename: lc.obtain_data(filename, "")))
+
+        for filename in (infile, infile + ".gz"):
+            print(f"{os.path.basename(filename)} ({os.path.getsize(filename) / 2**20:.0f} MiB), {args.ngal} rows, columns {columns}")
+            for name, loader in loaders:
+                t_load = timeit(lambda: loader(filename), args.repeat)
+                loaded = loader(filename)
+                t_transform = timeit(lambda: lc.convert_xyz2rdz(loaded, "", args.chilow, args.chiupp), 1) if filename == infile else np.nan
+                print(f"    {name:24s}: load {t_load:.3f} s, transform {t_transform:.3f} s")
+
+
+def bench_input_cache(args):
+    """ read time of a .fits.gz subbox decompressed by astropy, decompressed into the input cache, and found in it """
+    import gzip
+    import tempfile
+    from astropy.io import fits
+    from generate_light_cone import InputCache
+
+    lc = make_lightcone(args.config)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        infile = os.path.join(tmpdir, "subbox.fits.gz")
+        with gzip.open(infile, "wb", compresslevel=1) as f:
+            fits.BinTableHDU(synthetic_subbox(args.ngal, lc.box_length)).writeto(f)
+        print(f"{os.path.basename(infile)} ({os.path.getsize(infile) / 2**20:.0f} MiB), {args.ngal} rows, columns {lc.columns()}")
+
+        t_gzip = timeit(lambda: lc.obtain_data(infile, ""), args.repeat)
+
+        lc.input_cache = InputCache(os.path.join(tmpdir, "cache"), 2**40)
+        start = time.perf_counter()
+        lc.obtain_data(infile, "")
+        t_miss = time.perf_counter() - start
+        t_hit = timeit(lambda: lc.obtain_data(infile, ""), args.repeat)
+
+    print(f"    decompressed by astropy     : {t_gzip:.3f} s")
+    print(f"    decompressed into the cache : {t_miss:.3f} s")
+    print(f"    read from the cache         : {t_hit:.3f} s ({t_gzip / t_hit:.1f}x)")
+
+
+def process_memory():
+    """ (anonymous, file backed) resident memory of this process in bytes: only the first is private to the process for sure """
+    memory = {}
+    with open("/proc/self/smaps_rollup", "r") as f:
+        for line in f:
+            fields = line.split()
+            memory[fields[0].rstrip(":")] = fields[1]
+    return int(memory["Anonymous"]) * 1024, (int(memory["Rss"]) - int(memory["Anonymous"])) * 1024
+
+
+_bench_lightcone = None
+
+
+def memmap_worker(task):
+    infile, chilow, chiupp = task
+    anon_start = process_memory()[0]
+    start = time.perf_counter()
+    data = _bench_lightcone.obtain_data(infile, "")
+    anon_data, file_data = process_memory()
+    accumulator, ngalbox = _bench_lightcone.accumulate_shell(data, "", chilow, chiupp)
+    elapsed = time.perf_counter() - start
+    return elapsed, anon_data - anon_start, file_data
+
+
+def bench_memmap(args):
+    """ memory of nproc workers that transform the same subbox, read from the FITS file or memory mapped from its raw columns """
+    import tempfile
+    import multiprocessing as mp
+    from astropy.io import fits
+    from generate_light_cone import columns_dir, write_columns
+
+    global _bench_lightcone
+    _bench_lightcone = make_lightcone(args.config)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        infile = os.path.join(tmpdir, "subbox.fits")
+        fits.BinTableHDU(synthetic_subbox(args.ngal, _bench_lightcone.box_length)).writeto(infile)
+        print(f"{args.ngal} rows, columns {_bench_lightcone.columns()}, {args.nproc} workers, shell [{args.chilow}, {args.chiupp}] Mpc/h")
+
+        for name in ("FITS table", "raw columns"):
+            if name == "raw columns":
+                with fits.open(infile, memmap=True) as hdul:
+                    write_columns(hdul[1].data, columns_dir(infile), infile)
+            with mp.get_context("fork").Pool(args.nproc) as pool:
+                results = pool.map(memmap_worker, [(infile, args.chilow, args.chiupp)] * args.nproc, chunksize=1)
+            elapsed, anonymous, file_backed = np.max(results, axis=0)
+            print(f"    {name:12s}: {elapsed:.3f} s; per worker, once the subbox is loaded: {anonymous / 2**20:6.1f} MiB private, {file_backed / 2**20:6.1f} MiB of page cache")
+
+
+def bench_subbox_cache(args):
+    """ read time of a .fits.gz subbox over consecutive shells, read every time or kept in the subbox cache """
+    import gzip
+    import tempfile
+    from astropy.io import fits
+    from generate_light_cone import SubboxCache
+
+    lc = make_lightcone(args.config)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        infile = os.path.join(tmpdir, "subbox.fits.gz")
+        with gzip.open(infile, "wb", compresslevel=1) as f:
+            fits.BinTableHDU(synthetic_subbox(args.ngal, lc.box_length)).writeto(f)
+        print(f"{os.path.basename(infile)}, {args.ngal} rows, {args.nshells} shells of {lc.shellwidth} Mpc/h from {args.chilow} Mpc/h")
+
+        for subbox_cache in (None, SubboxCache(2**34)):
+            lc.subbox_cache = subbox_cache
+            read_time, compute_time = 0., 0.
+            for shell in range(args.nshells):
+                chilow = args.chilow + shell * lc.shellwidth
+                result = lc.generate_shell(infile, "", chilow, chilow + lc.shellwidth)
+                result.shells.attach()
+                result.shells.release()
+                read_time    += result.times[0]
+                compute_time += result.times[1]
+            print(f"    {'subbox cache' if subbox_cache is not None else 'no cache':12s}: {read_time:.3f} s reading, {compute_time:.3f} s computing")
+
+
+def bench_shell_io(args):
+    """ write and read throughput and compression ratio of the shell files with the storage settings of ShellFilters """
+    import tempfile
+    import h5py
+    from shell_store import ShellFilters
+
+    aux_columns = {"Z_RSD": "mock", "ID": "random", "ONEplusDELTA": "ic"}
+    if args.shell is not None:
+        ### Real shell columns
+        with h5py.File(args.shell, "r") as f:
+            mode = next(mode for col, mode in aux_columns.items() if col in f["galaxy"])
+            aux_col = next(col for col in aux_columns if col in f["galaxy"])
+            shell = {"ra0": f["galaxy/RA"][()], "dec0": f["galaxy/DEC"][()], "zz0": f["galaxy/Z_COSMO"][()], "aux0": f["galaxy"][aux_col][()]}
+        if mode == "ic":
+            shell["aux0"] = shell["aux0"] - 1
+        lc = make_lightcone(args.config, mock_random_ic=mode)
+    else:
+        ### A shell of the pipeline, from a synthetic subbox
+        lc = make_lightcone(args.config)
+        data = synthetic_subbox(args.ngal, lc.box_length)
+        ra, dec, zz, aux = lc.accumulate_shell({col: data[col].astype(np.float32) for col in lc.columns()}, "", args.chilow, args.chiupp)[0].assemble()
+        shell = {"ra0": ra, "dec0": dec, "zz0": zz, "aux0": aux}
+    nbytes = 4 * 4 * len(shell["ra0"])
+    print(f"{len(shell['ra0'])} objects, {nbytes / 2**20:.1f} MiB of columns")
+
+    compressors = [("lzf", None), ("gzip", 1), ("gzip", 4)]
+    try:
+        import hdf5plugin
+        compressors += [("blosc:lz4", None), ("blosc:zstd", 1)]
+    except ImportError:
+        print("hdf5plugin is not installed, blosc is not tested")
+
+    settings = [ShellFilters()]
+    for compression, level in compressors:
+        for shuffle in (False, True):
+            settings.append(ShellFilters(compression, level=level, shuffle=shuffle, chunk_size=args.chunk_size))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for filters in settings:
+            lc.shell_filters = filters
+            outfile = os.path.join(tmpdir, "shell.hdf5")
+            t_write = timeit(lambda: lc.save_shell(outfile, [shell], 0, 0, 0, 0), args.repeat)
+
+            def read():
+                with h5py.File(outfile, "r") as f:
+                    return [f["galaxy"][col][()] for col in f["galaxy"]]
+            t_read = timeit(read, args.repeat)
+            ratio = nbytes / os.path.getsize(outfile)
+            print(f"    {str(filters):45s}: write {nbytes / t_write / 2**20:7.1f} MiB/s, read {nbytes / t_read / 2**20:7.1f} MiB/s, ratio {ratio:.2f}")
+
+
+def bench_shell_store(args):
+    """ writing nshells shells and reading them back, as a file per shell and as a single shell store """
+    import tempfile
+    from shell_store import ShellStore, list_shells, iterate_shells
+
+    lc = make_lightcone(args.config)
+    rng = np.random.default_rng(0)
+    shell = {col: rng.uniform(0, 1, size=args.ngal).astype(np.float32) for col in ("ra0", "dec0", "zz0", "aux0")}
+    print(f"{args.nshells} shells of {args.ngal} objects")
+
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmpdir:
+        for layout in ("files", "store"):
+            outpath = os.path.join(tmpdir, layout)
+            os.makedirs(outpath)
+            store_file = os.path.join(outpath, "shells_all.hdf5")
+            lc.store = ShellStore(store_file) if layout == "store" else None
+
+            start = time.perf_counter()
+            for shellnum in range(args.nshells):
+                lc.save_shell(os.path.join(outpath, f"shell_{shellnum}.hdf5"), [shell], args.ngal, shellnum, 0, 0)
+            t_write = time.perf_counter() - start
+
+            ### A downstream pass: list the shells, then read the attributes and a column of each
+            inpath = store_file if layout == "store" else outpath
+            start = time.perf_counter()
+            nshells = len(list_shells(inpath))
+            for name, f in iterate_shells(inpath):
+                ngal, ra = f.attrs["NGAL"], f["galaxy/RA"][()]
+            t_read = time.perf_counter() - start
+            print(f"    {layout:5s}: {len(os.listdir(outpath))} files, write {t_write:.3f} s, list and read {nshells} shells {t_read:.3f} s")
+    lc.store = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the light-cone generation")
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    p = subparsers.add_parser("accumulator", help="np.append vs ShellAccumulator on a many-tile shell")
+    p.add_argument("--ngal", type=int, default=2000000)
+    p.add_argument("--box_length", type=float, default=500)
+    p.add_argument("--chilow", type=float, default=1500)
+    p.add_argument("--chiupp", type=float, default=1525)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_accumulator)
+
+    p = subparsers.add_parser("distance_table", help="DistanceTable vs CAMB redshift_at_comoving_radial_distance")
+    p.add_argument("--file_camb", type=str, default="./ABACUS/params_Abacus_cosmo000.ini")
+    p.add_argument("--zmax", type=float, default=1.65)
+    p.add_argument("--tol", type=float, default=1e-8)
+    p.add_argument("--nlookup", type=int, default=1000000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_distance_table)
+
+    p = subparsers.add_parser("angles", help="healpy vec2ang + tp2rd vs the xyz2rd kernel")
+    p.add_argument("--ngal", type=int, default=5000000)
+    p.add_argument("--chi", type=float, default=3000)
+    p.add_argument("--dtype", type=str, default="float32")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_angles)
+
+    p = subparsers.add_parser("float32", help="precision and memory of the float32 compute mode")
+    p.add_argument("--config", type=str, default="./EZmock/config/config_EZmock_ELG_6Gpc_2ND_GEN.ini")
+    p.add_argument("--z", type=float, default=1.65)
+    p.add_argument("--ngal", type=int, default=2000000)
+    p.add_argument("--eps", type=float, default=0.01)
+    p.set_defaults(func=bench_float32)
+
+    p = subparsers.add_parser("fused", help="numexpr reference vs the fused numba kernel")
+    p.add_argument("--config", type=str, default="./EZmock/config/config_EZmock_ELG_6Gpc_2ND_GEN.ini")
+    p.add_argument("--ngal", type=int, default=2000000)
+    p.add_argument("--chilow", type=float, default=2600)
+    p.add_argument("--chiupp", type=float, default=3250)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_fused)
+
+    p = subparsers.add_parser("replicas", help="runtime against the box size, replica by replica vs batched replicas")
+    p.add_argument("--config", type=str, default="./ABACUS/config/config_ABACUS_ELG.ini")
+    p.add_argument("--box_lengths", type=float, nargs="+", default=[250, 500, 1000, 2000])
+    p.add_argument("--density", type=float, default=1e-4)
+    p.add_argument("--chilow", type=float, default=3000)
+    p.add_argument("--chiupp", type=float, default=3025)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_replicas)
+
+    p = subparsers.add_parser("cell_index", help="brute force vs cell index selection for several shell widths")
+    p.add_argument("--config", type=str, default="./EZmock/config/config_EZmock_LRG.ini")
+    p.add_argument("--ngal", type=int, default=2000000)
+    p.add_argument("--cell_size", type=float, default=25)
+    p.add_argument("--chilow", type=float, default=2600)
+    p.add_argument("--widths", type=float, nargs="+", default=[25, 650])
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_cell_index)
+
+    p = subparsers.add_parser("chunks", help="peak memory of a subbox read whole (chunk size 0) or in chunks")
+    p.add_argument("--config", type=str, default="./EZmock/config/config_EZmock_ELG_6Gpc_2ND_GEN.ini")
+    p.add_argument("--ngal", type=int, default=4000000)
+    p.add_argument("--chunk_sizes", type=int, nargs="+", default=[0, 1000000, 250000])
+    p.add_argument("--chilow", type=float, default=2600)
+    p.add_argument("--chiupp", type=float, default=3250)
+    p.set_defaults(func=bench_chunks)
+
+    p = subparsers.add_parser("loader", help="load time of .fits and .fits.gz subboxes with astropy, fitsio and obtain_data")
+    p.add_argument("--config", type=str, default="./EZmock/config/config_EZmock_ELG_6Gpc_2ND_GEN.ini")
+    p.add_argument("--ngal", type=int, default=4000000)
+    p.add_argument("--chilow", type=float, default=2600)
+    p.add_argument("--chiupp", type=float, default=3250)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_loader)
+
+    p = subparsers.add_parser("input_cache", help="read time of a .fits.gz subbox with and without the input cache")
+    p.add_argument("--config", type=str, default="./EZmock/config/config_EZmock_ELG_6Gpc_2ND_GEN.ini")
+    p.add_argument("--ngal", type=int, default=4000000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_input_cache)
+
+    p = subparsers.add_parser("memmap", help="memory of workers that transform the same subbox from the FITS file or from its memory mapped raw columns")
+    p.add_argument("--config", type=str, default="./EZmock/config/config_EZmock_ELG_6Gpc_2ND_GEN.ini")
+    p.add_argument("--ngal", type=int, default=4000000)
+    p.add_argument("--nproc", type=int, default=4)
+    p.add_argument("--chilow", type=float, default=3000)
+    p.add_argument("--chiupp", type=float, default=3025)
+    p.set_defaults(func=bench_memmap)
+
+    p = subparsers.add_parser("subbox_cache", help="read time of a .fits.gz subbox over consecutive shells, with and without the subbox cache")
+    p.add_argument("--config", type=str, default="./EZmock/config/config_EZmock_ELG_6Gpc_2ND_GEN.ini")
+    p.add_argument("--ngal", type=int, default=4000000)
+    p.add_argument("--nshells", type=int, default=5)
+    p.add_argument("--chilow", type=float, default=3000)
+    p.set_defaults(func=bench_subbox_cache)
+
+    p = subparsers.add_parser("shell_io", help="write and read throughput and compression ratio of the shell files")
+    p.add_argument("--config", type=str, default="./EZmock/config/config_EZmock_ELG_6Gpc_2ND_GEN.ini")
+    p.add_argument("--shell", type=str, default=None, help="shell file to take the columns from, instead of a synthetic shell")
+    p.add_argument("--ngal", type=int, default=4000000)
+    p.add_argument("--chilow", type=float, default=2600)
+    p.add_argument("--chiupp", type=float, default=3250)
+    p.add_argument("--chunk_size", type=int, default=2**18)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_shell_io)
+
+    p = subparsers.add_parser("shell_store", help="writing and reading the shells as a file per shell and as a single shell store")
+    p.add_argument("--config", type=str, default="./EZmock/config/config_EZmock_ELG_6Gpc_2ND_GEN.ini")
+    p.add_argument("--nshells", type=int, default=400)
+    p.add_argument("--ngal", type=int, default=10000)
+    p.add_argument("--tmpdir", type=str, default=None, help="directory to write the shells in, e.g. on the parallel file system")
+    p.set_defaults(func=bench_shell_store)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import sys
+import os
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from astropy.io import fits
+from generate_light_cone import columns_dir, write_columns, remove_columns
+
+
+def up_to_date(infile, directory):
+    """ whether directory holds the columns of the current version of infile """
+    try:
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    stat = os.stat(infile)
+    return meta["mtime"] == stat.st_mtime and meta["size"] == stat.st_size
+
+
+def convert(infile, force=False):
+    """ writes the columns of the subbox table of infile as raw .npy arrays into columns_dir(infile) """
+    directory = columns_dir(infile)
+    if not force and up_to_date(infile, directory):
+        print(f"INFO: {directory} is up to date.")
+        return
+    if os.path.isdir(directory):
+        remove_columns(directory)
+
+    start = time.perf_counter()
+    with fits.open(infile, memmap=not infile.endswith(".gz")) as hdul:
+        nbytes = write_columns(hdul[1].data, directory, infile)
+    print(f"INFO: {infile} -> {directory}: {nbytes / 2**20:.1f} MiB in {time.perf_counter() - start:.3f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stores the columns of subbox FITS tables as raw arrays, memory mapped by generate_light_cone.py")
+    parser.add_argument("infiles", nargs="+", help="subbox files, e.g. LRG.sub*.fits.gz")
+    parser.add_argument("--force", action="store_true", help="convert again the subboxes whose columns are up to date")
+    args = parser.parse_args()
+
+    for infile in args.infiles:
+        convert(infile, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
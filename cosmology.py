@@ -0,0 +1,111 @@
+import os
+import hashlib
+import numpy as np
+
+
+def run_background(file_camb):
+    """ Background-only CAMB run from the parameter file: distances, no CMB nor power spectra """
+    import camb
+
+    pars = camb.read_ini(file_camb)
+    camb.set_feedback_level(level=100)
+    results = camb.get_background(pars)
+    return pars.h, results
+
+
+def load_distance_table(file_camb, z_max, margin, tol=1e-8, cache_dir=None):
+    """ Distance table of the cosmology in file_camb up to z_max plus margin [Mpc/h].
+    Tables are cached in cache_dir, keyed by a hash of the parameter file and of the table settings. """
+    with open(file_camb, "rb") as f:
+        key = hashlib.sha1(f.read() + f"{z_max!r} {margin!r} {tol!r}".encode()).hexdigest()
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f"distance_table_{key}.npz")
+        if os.path.isfile(cache_file):
+            print(f"INFO: Distance table read from {cache_file}")
+            return DistanceTable.load(cache_file)
+
+    h, results = run_background(file_camb)
+    chi_max = results.comoving_radial_distance(z_max) * h + margin
+    table = DistanceTable.from_camb(results, h, chi_max, tol=tol)
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        table.save(cache_file)
+    return table
+
+
+class DistanceTable():
+    """ Dense comoving distance <-> redshift tables in Mpc/h, built once per cosmology.
+
+    The table is uniform in comoving distance, so that z(r) is a direct index
+    and a linear interpolation.
+    """
+    def __init__(self, chi_grid, z_grid, h, max_error):
+        self.chi_grid  = chi_grid
+        self.z_grid    = z_grid
+        self.h         = h
+        self.max_error = max_error
+
+        self.dchi  = chi_grid[1] - chi_grid[0]
+        self.slope = np.diff(z_grid) / self.dchi
+        self.typed_grids = {}
+
+    @classmethod
+    def from_camb(cls, results, h, chi_max, tol=1e-8, npoints=1024, max_npoints=2**22):
+        """ The grid is refined until it agrees with CAMB to better than tol at the midpoints of the table """
+        chi_max = 1.01 * chi_max + 1.
+        while True:
+            chi_grid = np.linspace(0, chi_max, npoints)
+            z_grid   = results.redshift_at_comoving_radial_distance(chi_grid / h)
+            table    = cls(chi_grid, z_grid, h, 0.)
+
+            chi_mid = 0.5 * (chi_grid[1:] + chi_grid[:-1])
+            z_camb  = results.redshift_at_comoving_radial_distance(chi_mid / h)
+            table.max_error = np.max(np.abs(table.redshift(chi_mid) - z_camb))
+
+            if table.max_error <= tol or npoints >= max_npoints:
+                break
+            npoints = 2 * npoints
+
+        if table.max_error > tol:
+            print(f"WARNING: The distance table reached {npoints} points with an error of {table.max_error:.2e} > {tol:.2e}.")
+        if np.any(table.slope <= 0):
+            print("ERROR: The redshift is not monotonic in comoving distance.")
+            os._exit(1)
+
+        print(f"INFO: Distance table with {npoints} points up to {chi_max:.1f} Mpc/h (max error in z: {table.max_error:.2e})")
+        return table
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            return cls(f["chi_grid"], f["z_grid"], float(f["h"]), float(f["max_error"]))
+
+    def save(self, filename):
+        filename_tmp = filename + f"_tmp{os.getpid()}"
+        with open(filename_tmp, "wb") as f:
+            np.savez(f, chi_grid=self.chi_grid, z_grid=self.z_grid, h=self.h, max_error=self.max_error)
+        os.rename(filename_tmp, filename)
+
+    def grids(self, dtype):
+        """ chi, z and slope tables in the given dtype """
+        if dtype not in self.typed_grids:
+            self.typed_grids[dtype] = (self.chi_grid.astype(dtype), self.z_grid.astype(dtype), self.slope.astype(dtype), dtype(1. / self.dchi))
+        return self.typed_grids[dtype]
+
+    def redshift(self, chi):
+        """ redshift at the comoving distance chi [Mpc/h], 0 <= chi <= chi_max.
+        float32 distances are looked up in float32, anything else in float64. """
+        chi = np.asarray(chi)
+        dtype = np.float32 if chi.dtype == np.float32 else np.float64
+        chi_grid, z_grid, slope, inv_dchi = self.grids(dtype)
+
+        chi = chi.astype(dtype, copy=False)
+        index = np.clip((chi * inv_dchi).astype(np.intp), 0, len(slope) - 1)
+        return z_grid[index] + (chi - chi_grid[index]) * slope[index]
+
+    def comoving_distance(self, z):
+        """ comoving distance [Mpc/h] at redshift z """
+        return np.interp(z, self.z_grid, self.chi_grid)
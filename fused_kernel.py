@@ -0,0 +1,134 @@
+import math
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+MOCK, RANDOM, IC = 0, 1, 2
+
+
+def observed(x, y, z, matrix, rotate, single):
+    """ rotated position and distance of an object translated to the observer, in the precision of the numexpr path:
+    the translation is rounded to single precision for single precision inputs, the rotation is carried out in double
+    precision, and without a rotation the distance is computed in the precision of the inputs """
+    if single and not rotate:
+        xf = np.float32(x)
+        yf = np.float32(y)
+        zf = np.float32(z)
+        rf = np.sqrt(xf * xf + yf * yf + zf * zf)
+        return np.float64(xf), np.float64(yf), np.float64(zf), np.float64(rf)
+    if single:
+        x = np.float64(np.float32(x))
+        y = np.float64(np.float32(y))
+        z = np.float64(np.float32(z))
+    if rotate:
+        sx = matrix[0, 0] * x + matrix[0, 1] * y + matrix[0, 2] * z
+        sy = matrix[1, 0] * x + matrix[1, 1] * y + matrix[1, 2] * z
+        sz = matrix[2, 0] * x + matrix[2, 1] * y + matrix[2, 2] * z
+    else:
+        sx, sy, sz = x, y, z
+    return sx, sy, sz, math.sqrt(sx * sx + sy * sy + sz * sz)
+
+
+def count_selected(px, py, pz, shifts, matrix, rotate, single, chilow, chiupp, counts):
+    """ number of objects of every replica with chilow < r < chiupp """
+    for t in range(shifts.shape[0]):
+        ox = shifts[t, 0]
+        oy = shifts[t, 1]
+        oz = shifts[t, 2]
+        n = 0
+        for i in range(px.shape[0]):
+            sx, sy, sz, r = observed(px[i] + ox, py[i] + oy, pz[i] + oz, matrix, rotate, single)
+            if r > chilow and r < chiupp:
+                n += 1
+        counts[t] = n
+
+
+def fill_selected(px, py, pz, vx, vy, vz, aux_in, mode, shifts, matrix, rotate, single, chilow, chiupp,
+                  chi_grid, z_grid, slope, inv_dchi, clight, ra, dec, zz, aux, rr):
+    """ translate, rotate, select, convert to ra/dec/z and apply the RSD in a single pass per replica """
+    rad2deg = 180.0 / math.pi
+    nmax = slope.shape[0] - 1
+    j = 0
+    for t in range(shifts.shape[0]):
+        ox = shifts[t, 0]
+        oy = shifts[t, 1]
+        oz = shifts[t, 2]
+        for i in range(px.shape[0]):
+            sx, sy, sz, r = observed(px[i] + ox, py[i] + oy, pz[i] + oz, matrix, rotate, single)
+            if not (r > chilow and r < chiupp):
+                continue
+
+            k = min(max(int(r * inv_dchi), 0), nmax)
+            zp = z_grid[k] + (r - chi_grid[k]) * slope[k]
+
+            phi = math.atan2(sy, sx) * rad2deg
+            if phi < 0:
+                phi += 360.0
+            ra[j]  = phi
+            dec[j] = math.atan2(sz, math.hypot(sx, sy)) * rad2deg
+            zz[j]  = zp
+            rr[j]  = r
+
+            if mode == MOCK:
+                if rotate:
+                    qx = (matrix[0, 0] * vx[i] + matrix[0, 1] * vy[i] + matrix[0, 2] * vz[i]) * 1000.
+                    qy = (matrix[1, 0] * vx[i] + matrix[1, 1] * vy[i] + matrix[1, 2] * vz[i]) * 1000.
+                    qz = (matrix[2, 0] * vx[i] + matrix[2, 1] * vy[i] + matrix[2, 2] * vz[i]) * 1000.
+                else:
+                    qx = vx[i] * 1000.
+                    qy = vy[i] * 1000.
+                    qz = vz[i] * 1000.
+                vlos = qx * (sx / r) + qy * (sy / r) + qz * (sz / r)
+                aux[j] = zp + (vlos / clight) * (1 + zp)
+            else:
+                aux[j] = aux_in[i]
+            j += 1
+
+
+if numba is not None:
+    observed       = numba.njit(cache=True)(observed)
+    count_selected = numba.njit(cache=True)(count_selected)
+    fill_selected  = numba.njit(cache=True)(fill_selected)
+
+
+def native(array):
+    """ contiguous array in native byte order, as required by the compiled kernels """
+    return np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("="))
+
+
+def fused_selection(px, py, pz, vel, aux_in, mode, tiles, box_length, origin, matrix, chilow, chiupp,
+                    distances, clight, dtype=np.float64, aux_dtype=np.float64, rotate=True):
+    """ (ra, dec, z, aux, r) of the objects of all the replicas in tiles that fall in [chilow, chiupp].
+    The objects are translated in the precision of the positions, as in the numexpr path, and the rest of the
+    arithmetic is carried out in double precision; the outputs have the given dtypes. """
+    px, py, pz = native(px), native(py), native(pz)
+    if mode == MOCK:
+        vx, vy, vz = (native(v) for v in vel)
+        aux_in = np.zeros(0, dtype=np.float64)
+    else:
+        vx = vy = vz = np.zeros(0, dtype=px.dtype)
+        aux_in = native(aux_in)
+
+    ### The shifts of the replicas are rounded to the type of the positions, as the numexpr path does
+    shifts = (box_length * np.asarray(tiles, dtype=np.float64) - np.asarray(origin, dtype=np.float64)).astype(px.dtype).astype(np.float64)
+    shifts = np.ascontiguousarray(shifts.reshape(-1, 3))
+    matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+    single = px.dtype == np.float32
+    chi_grid, z_grid, slope, inv_dchi = distances.grids(np.float64)
+
+    counts = np.zeros(len(shifts), dtype=np.int64)
+    count_selected(px, py, pz, shifts, matrix, bool(rotate), bool(single), float(chilow), float(chiupp), counts)
+    nsel = int(np.sum(counts))
+
+    ra  = np.empty(nsel, dtype=dtype)
+    dec = np.empty(nsel, dtype=dtype)
+    zz  = np.empty(nsel, dtype=dtype)
+    rr  = np.empty(nsel, dtype=dtype)
+    aux = np.empty(nsel, dtype=aux_dtype)
+    fill_selected(px, py, pz, vx, vy, vz, aux_in, mode, shifts, matrix, bool(rotate), bool(single), float(chilow), float(chiupp),
+                  chi_grid, z_grid, slope, float(inv_dchi), float(clight), ra, dec, zz, aux, rr)
+    return ra, dec, zz, aux, rr
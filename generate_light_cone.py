@@ -5,27 +5,610 @@
 
 import sys
 import os
+import json
+import time
+import shutil
+import signal
+import hashlib
+import queue
+import threading
 import configparser
-import multiprocessing as mp
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory, resource_tracker
 from astropy.io import fits
 import h5py
 
-import camb
 import numpy as np
-import healpy as hp
 import numexpr as ne
 
 from rotation_matrix import RotationMatrix
+from cosmology import load_distance_table
+from shell_store import ShellFilters, ShellStore
+import fused_kernel
 
 ne.set_num_threads(4)
 
-def tp2rd(tht, phi):
-	""" convert theta,phi to ra/dec """
-	ra  = phi / np.pi * 180.0
-	dec = -1 * (tht / np.pi * 180.0 - 90.0)
+def xyz2rd(sx, sy, sz):
+	""" convert cartesian positions around the observer to ra/dec in degrees """
+	rad2deg = 180.0 / np.pi
+
+	ra = np.arctan2(sy, sx)
+	ra *= rad2deg
+	np.add(ra, 360.0, out=ra, where=(ra < 0))
+
+	dec = np.hypot(sx, sy)
+	np.arctan2(sz, dec, out=dec)
+	dec *= rad2deg
 	return ra, dec
 
 
+_worker_lightcone = None
+
+
+def init_worker(lightcone):
+	""" keeps the LightCone of the run, with its distance table and rotation, in a worker of the pool """
+	global _worker_lightcone
+	_worker_lightcone = lightcone
+	die_with_parent(lightcone.segment_owner)
+
+
+def die_with_parent(parent):
+	""" has Linux kill this worker as soon as its parent exits (prctl PR_SET_PDEATHSIG), so that a worker left behind
+	by a main process that was killed cannot create shared memory segments after the next run has swept them """
+	try:
+		import ctypes
+		ctypes.CDLL(None, use_errno=True).prctl(1, signal.SIGKILL)             # PR_SET_PDEATHSIG
+	except (OSError, AttributeError):
+		pass
+	if os.getppid() != parent:
+		os._exit(1)
+
+
+def worker_pid():
+	return os.getpid()
+
+
+def run_subbox_task(target, infile, prefix, shell_args):
+	""" runs the LightCone method target on one subbox in a worker of the pool """
+	return getattr(_worker_lightcone, target)(infile, prefix, *shell_args)
+
+
+class WorkerPool():
+	""" nproc workers started once per run, that process the (shell, subbox) tasks of all the shells.
+	Every worker has its own queue, so that the tasks can be sent to the worker that already holds their subbox. """
+	def __init__(self, lightcone, nproc):
+		self.lightcone  = lightcone
+		self.nproc      = nproc
+		self.executors  = None
+		self.pids       = []
+		self.ntasks     = 0
+		self.start_time = 0.
+		self.stop_time  = 0.
+
+	def submit(self, worker, target, infile, prefix, shell_args):
+		if self.executors is None:
+			start = time.perf_counter()
+			self.executors = [ProcessPoolExecutor(max_workers=1, initializer=init_worker, initargs=(self.lightcone,)) for i in range(self.nproc)]
+			futures   = [executor.submit(worker_pid) for executor in self.executors]
+			self.pids = [future.result() for future in futures]                # start the workers now, so that their start up is timed
+			self.start_time = time.perf_counter() - start
+		self.ntasks += 1
+		return self.executors[worker].submit(run_subbox_task, target, infile, prefix, shell_args)
+
+	def result(self, future):
+		try:
+			return future.result()
+		except BrokenProcessPool:
+			print("ERROR: A worker process terminated abruptly, see its messages above.")
+			self.abort()
+			os._exit(1)
+
+	def abort(self):
+		""" kills the workers and unlinks the segments of the results not yet released, before the run exits on an error.
+		The workers are waited for first, so that none of them is left to create a segment after the sweep. """
+		for pid in self.pids:
+			try:
+				os.kill(pid, signal.SIGKILL)
+			except ProcessLookupError:
+				pass
+		for pid in self.pids:
+			try:
+				os.waitpid(pid, 0)
+			except ChildProcessError:
+				pass                                    # already reaped by the executor
+		SharedShells.sweep(self.lightcone.segment_owner)
+
+	def shutdown(self):
+		if self.executors is None:
+			return
+		start = time.perf_counter()
+		for executor in self.executors:
+			executor.shutdown(wait=True)
+		self.executors = None
+		self.stop_time = time.perf_counter() - start
+		print(f"INFO: Worker pool of {self.nproc} processes: started in {self.start_time:.3f} s, stopped in {self.stop_time:.3f} s, {self.ntasks} subbox tasks.")
+
+
+class ReadAhead():
+	""" reads the subbox files of the upcoming tasks in a background thread, so that the workers find them in memory (page cache) """
+	def __init__(self, depth, resolve=None, block_size=2**24):
+		self.depth      = depth
+		self.resolve    = resolve if resolve is not None else (lambda infile: [infile])
+		self.block_size = block_size
+		self.requests   = queue.Queue()
+		self.recent     = deque(maxlen=4 * max(depth, 1))
+		self.read_time  = 0.
+		self.idle_time  = 0.
+		self.nfiles     = 0
+		self.nbytes     = 0
+		self.thread     = None
+		if depth > 0:
+			self.thread = threading.Thread(target=self.run, daemon=True)
+			self.thread.start()
+
+	def request(self, infiles):
+		""" files of the next tasks, in the order they will be needed; only the first depth are read ahead """
+		if self.thread is None:
+			return
+		for infile in infiles[:self.depth]:
+			if infile not in self.recent:
+				self.recent.append(infile)
+				self.requests.put(infile)
+
+	def run(self):
+		buffer = bytearray(self.block_size)
+		while True:
+			start = time.perf_counter()
+			infile = self.requests.get()
+			self.idle_time += time.perf_counter() - start
+			if infile is None:
+				return
+
+			start = time.perf_counter()
+			for filename in self.resolve(infile):
+				try:
+					with open(filename, "rb", buffering=0) as f:
+						while True:
+							nread = f.readinto(buffer)
+							if not nread:
+								break
+							self.nbytes += nread
+					self.nfiles += 1
+				except OSError:
+					pass                                # the worker reports unreadable files
+			self.read_time += time.perf_counter() - start
+
+	def close(self):
+		if self.thread is None:
+			return
+		self.requests.put(None)
+		self.thread.join()
+		print(f"INFO: Read-ahead: {self.nfiles} files ({self.nbytes / 2**30:.2f} GiB) read in {self.read_time:.3f} s, idle for {self.idle_time:.3f} s.")
+
+
+class WriteBehind():
+	""" runs the shell writes in a background thread, with at most depth writes waiting; depth = 0 writes synchronously.
+	abort is called before the run exits on a failed write. """
+	def __init__(self, depth, abort=None):
+		self.depth      = depth
+		self.abort      = abort
+		self.write_time = 0.
+		self.wait_time  = 0.
+		self.nwrites    = 0
+		self.error      = None
+		self.thread     = None
+		if depth > 0:
+			self.jobs   = queue.Queue(maxsize=depth)
+			self.thread = threading.Thread(target=self.run, daemon=True)
+			self.thread.start()
+
+	def submit(self, func, *args):
+		self.check()
+		if self.thread is None:
+			self.write(func, args)
+			return
+		start = time.perf_counter()
+		self.jobs.put((func, args))
+		self.wait_time += time.perf_counter() - start
+
+	def write(self, func, args):
+		start = time.perf_counter()
+		func(*args)
+		self.write_time += time.perf_counter() - start
+		self.nwrites += 1
+
+	def run(self):
+		while True:
+			job = self.jobs.get()
+			if job is None:
+				return
+			if self.error is None:
+				try:
+					self.write(*job)
+				except BaseException as error:
+					self.error = error
+
+	def check(self):
+		if self.error is not None:
+			print(f"ERROR: Writing a shell failed: {self.error!r}")
+			if self.abort is not None:
+				self.abort()
+			os._exit(1)
+
+	def close(self):
+		if self.thread is not None:
+			self.jobs.put(None)
+			self.thread.join()
+		self.check()
+		print(f"INFO: Write-behind: {self.nwrites} writes in {self.write_time:.3f} s, {self.wait_time:.3f} s waiting for the writer.")
+
+
+class ShellAccumulator():
+	""" collects the per-tile selections of a shell and assembles them once """
+	def __init__(self, aux_dtype=np.float64, dtype=np.float64):
+		self.dtype     = dtype
+		self.aux_dtype = aux_dtype
+		self.size      = 0
+
+		self.ra_chunks  = []
+		self.dec_chunks = []
+		self.z_chunks   = []
+		self.aux_chunks = []
+
+	def append(self, ra, dec, zz, aux):
+		self.ra_chunks.append(ra)
+		self.dec_chunks.append(dec)
+		self.z_chunks.append(zz)
+		self.aux_chunks.append(aux)
+		self.size += len(ra)
+
+	def fill(self, chunks, dtype, out=None):
+		if out is None:
+			out = np.empty(self.size, dtype=dtype)
+		index_i = 0
+		for chunk in chunks:
+			index_f = index_i + len(chunk)
+			out[index_i: index_f] = chunk
+			index_i = index_f
+		return out
+
+	def assemble(self, out=None):
+		""" copy every chunk once into typed output buffers, or into the (ra, dec, zz, aux) arrays out """
+		out = out or (None, None, None, None)
+		ra  = self.fill(self.ra_chunks,  self.dtype,     out[0])
+		dec = self.fill(self.dec_chunks, self.dtype,     out[1])
+		zz  = self.fill(self.z_chunks,   self.dtype,     out[2])
+		aux = self.fill(self.aux_chunks, self.aux_dtype, out[3])
+
+		self.ra_chunks, self.dec_chunks, self.z_chunks, self.aux_chunks = [], [], [], []
+		return ra, dec, zz, aux
+
+
+def native_columns(table, columns):
+	""" contiguous native-endian copies of the given columns of a FITS table (or of a slice of it) """
+	data = SubboxColumns()
+	for col in columns:
+		values = table.field(col)
+		data[col] = np.ascontiguousarray(values, dtype=values.dtype.newbyteorder("="))
+	return data
+
+
+class SubboxColumns(dict):
+	""" the columns of a subbox, by name; its length is the number of rows, as for a table """
+	def __len__(self):
+		return len(self["x"])
+
+	@property
+	def nbytes(self):
+		return sum(values.nbytes for values in self.values())
+
+	def in_memory(self):
+		""" whether the columns are held in memory rather than memory mapped """
+		return not any(isinstance(values, np.memmap) for values in self.values())
+
+
+def columns_dir(infile):
+	""" the directory of the raw column arrays of a subbox file: LRG.sub0.fits(.gz) -> LRG.sub0.columns """
+	name = infile[:-3] if infile.endswith(".gz") else infile
+	name = name[:-5] if name.endswith(".fits") else name
+	return name + ".columns"
+
+
+def write_columns(table, directory, infile):
+	""" writes every column of the FITS table read from infile as a native-endian .npy file into directory,
+	with the mtime and size of infile in meta.json; the directory is written as _tmp and renamed into place.
+	Returns the number of bytes written, 0 if directory already exists. """
+	directory_tmp = directory + f"_tmp{os.getpid()}"
+	os.makedirs(directory_tmp, exist_ok=True)
+	nbytes = 0
+	for col in table.columns.names:
+		values = table.field(col)
+		values = np.ascontiguousarray(values, dtype=values.dtype.newbyteorder("="))
+		np.save(os.path.join(directory_tmp, col.lower() + ".npy"), values)
+		nbytes += values.nbytes
+	stat = os.stat(infile)
+	with open(os.path.join(directory_tmp, "meta.json"), "w") as f:
+		json.dump({"infile": os.path.abspath(infile), "mtime": stat.st_mtime, "size": stat.st_size, "nrows": len(table), "nbytes": nbytes}, f)
+	try:
+		os.rename(directory_tmp, directory)
+	except OSError:
+		shutil.rmtree(directory_tmp, ignore_errors=True)                       # written by another process meanwhile
+		return 0
+	return nbytes
+
+
+def load_columns(directory, columns, mmap_mode=None):
+	""" the given columns from a directory of .npy files; with mmap_mode = "r" they are memory mapped, so that
+	all the processes that read the same subbox share its pages """
+	return SubboxColumns((col, np.load(os.path.join(directory, col + ".npy"), mmap_mode=mmap_mode)) for col in columns)
+
+
+def remove_columns(directory):
+	""" removes a directory of columns, renamed first so that no reader finds it partly removed """
+	directory_old = directory + f"_old{os.getpid()}"
+	try:
+		os.rename(directory, directory_old)
+	except OSError:
+		return False
+	shutil.rmtree(directory_old, ignore_errors=True)
+	return True
+
+
+class SubboxChunks():
+	""" the rows of a subbox table in chunks of chunk_size rows, read one at a time.
+	The extent of the positions is known once all the chunks have been read. """
+	def __init__(self, infile, chunk_size, columns, cached=None):
+		self.infile     = infile
+		self.chunk_size = chunk_size
+		self.columns    = columns
+		self.cached     = cached
+		self.lower      = None
+		self.upper      = None
+		if cached is not None:
+			self.nrows = len(cached)
+		else:
+			with fits.open(infile, memmap=True) as hdul:
+				self.nrows = hdul[1].header["NAXIS2"]
+
+	def __len__(self):
+		return self.nrows
+
+	def __iter__(self):
+		if self.cached is not None:
+			for first in range(0, self.nrows, self.chunk_size):
+				yield self.track(SubboxColumns((col, np.array(self.cached[col][first:first + self.chunk_size])) for col in self.columns))
+			return
+
+		with fits.open(self.infile, memmap=True) as hdul:
+			table = hdul[1].data
+			for first in range(0, self.nrows, self.chunk_size):
+				yield self.track(native_columns(table[first:first + self.chunk_size], self.columns))
+
+	def track(self, chunk):
+		lower = [np.min(chunk[col]) for col in ('x', 'y', 'z')]
+		upper = [np.max(chunk[col]) for col in ('x', 'y', 'z')]
+		self.lower = lower if self.lower is None else list(map(min, self.lower, lower))
+		self.upper = upper if self.upper is None else list(map(max, self.upper, upper))
+		return chunk
+
+	def extent(self):
+		if self.lower is None:
+			return None
+		return self.lower, self.upper
+
+
+class CellIndex():
+	""" uniform grid of cells over a subbox and the cell of every object """
+	def __init__(self, data, extent, cell_size):
+		self.lower  = np.asarray(extent[0], dtype=np.float64)
+		upper       = np.asarray(extent[1], dtype=np.float64)
+		self.ncells = np.maximum(1, np.ceil((upper - self.lower) / cell_size)).astype(np.int64)
+		self.size   = np.maximum(upper - self.lower, 1e-30) / self.ncells
+		self.visited = 0
+
+		self.cellid = np.zeros(len(data['x']), dtype=np.int32 if np.prod(self.ncells) < 2**31 else np.int64)
+		for axis, col in enumerate(('x', 'y', 'z')):
+			icell = np.floor((data[col] - self.lower[axis]) / self.size[axis])
+			self.cellid *= self.ncells[axis]
+			self.cellid += np.clip(icell, 0, self.ncells[axis] - 1).astype(self.cellid.dtype)
+
+	def candidates(self, shift, chilow, chiupp):
+		""" sorted indices of the objects of the cells that may fall in [chilow, chiupp] once shifted by shift """
+		### The squared distances to the nearest and farthest points of a cell are sums over the three axes
+		dmin2, dmax2 = 0, 0
+		for axis in range(3):
+			lower = self.lower[axis] + shift[axis] + self.size[axis] * np.arange(self.ncells[axis])
+			upper = lower + self.size[axis]
+			nearest  = np.clip(0, lower, upper)
+			farthest = np.maximum(np.abs(lower), np.abs(upper))
+			dmin2 = np.add.outer(dmin2, nearest * nearest)
+			dmax2 = np.add.outer(dmax2, farthest * farthest)
+
+		### The positions are shifted and rotated in single precision: pad the range well beyond their rounding
+		pad = 1e-4 * chiupp
+		hit = (np.sqrt(dmin2) <= chiupp + pad) & (np.sqrt(dmax2) >= chilow - pad)
+
+		objects = np.flatnonzero(hit.ravel()[self.cellid])
+		self.visited += len(objects)
+		return objects
+
+
+class SharedShells():
+	""" shell selections of one subbox in a shared memory segment, filled once by the worker and read in place by the parent.
+	Only the name of the segment and the number of objects of every shell are sent back to the parent.
+	The segments are named after the parent process, so that those left behind by a run that died can be found. """
+	directory = "/dev/shm"
+	def __init__(self, name, counts, dtype, aux_dtype):
+		self.name      = name
+		self.counts    = counts
+		self.dtype     = np.dtype(dtype)
+		self.aux_dtype = np.dtype(aux_dtype)
+		self.shm       = None
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state["shm"] = None
+		return state
+
+	def layout(self):
+		""" byte offset of the ra, dec, zz and aux arrays of every shell, and the size of the segment """
+		offsets, nbytes = {}, 0
+		for key, count in self.counts.items():
+			offsets[key] = []
+			for dtype in (self.dtype, self.dtype, self.dtype, self.aux_dtype):
+				offsets[key].append(nbytes)
+				nbytes += -(-count * dtype.itemsize // 8) * 8
+		return offsets, nbytes
+
+	@staticmethod
+	def prefix(owner):
+		return f"lightcone_{owner}_"
+
+	@classmethod
+	def sweep(cls, owner=None):
+		""" unlinks the segments of the run of the process owner, or of all the runs whose process is gone """
+		try:
+			names = os.listdir(cls.directory)
+		except OSError:
+			return 0
+		nswept = 0
+		for name in names:
+			fields = name.split("_")
+			if len(fields) != 4 or not name.startswith(cls.prefix(fields[1])):
+				continue
+			pid = fields[1]
+			if owner is not None and pid != str(owner):
+				continue
+			if owner is None:
+				try:
+					os.kill(int(pid), 0)
+					continue
+				except ProcessLookupError:
+					pass
+				except (PermissionError, ValueError):
+					continue
+			try:
+				os.remove(os.path.join(cls.directory, name))
+				nswept += 1
+			except OSError:
+				pass
+		return nswept
+
+	@classmethod
+	def from_accumulators(cls, accumulators, dtype, aux_dtype, owner):
+		""" assembles the ShellAccumulators {key: accumulator} directly into a new segment of the run of the process owner """
+		if os.getpid() != owner and os.getppid() != owner:
+			os._exit(1)                                 # the main process of the worker is gone, and nobody would release the segment
+		shared = cls(None, {key: accumulator.size for key, accumulator in accumulators.items()}, dtype, aux_dtype)
+		name   = cls.prefix(owner) + f"{os.getpid()}_{os.urandom(4).hex()}"
+		shared.shm  = shared_memory.SharedMemory(name=name, create=True, size=max(shared.layout()[1], 1))
+		shared.name = shared.shm.name
+		for key, accumulator in accumulators.items():
+			accumulator.assemble(out=shared.arrays(key))
+
+		### The parent attaches to the segment and unlinks it once written: it is no longer the worker's to clean up.
+		### If the parent dies before, its segments are unlinked on its error paths (WorkerPool.abort) or by the next run.
+		resource_tracker.unregister(shared.shm._name, "shared_memory")
+		shared.shm.close()
+		shared.shm = None
+		return shared
+
+	def attach(self):
+		self.shm = shared_memory.SharedMemory(name=self.name)
+
+	def arrays(self, key):
+		""" (ra, dec, zz, aux) views of the shell key """
+		offsets = self.layout()[0][key]
+		count   = self.counts[key]
+		dtypes  = (self.dtype, self.dtype, self.dtype, self.aux_dtype)
+		return tuple(np.ndarray(count, dtype=dtype, buffer=self.shm.buf, offset=offset) for dtype, offset in zip(dtypes, offsets))
+
+	def shell(self, key):
+		ra0, dec0, zz0, aux0 = self.arrays(key)
+		return {"ra0": ra0, "dec0": dec0, "zz0": zz0, "aux0": aux0}
+
+	def release(self):
+		""" unlinks the segment; the memory is freed once the last view of it is gone """
+		self.shm.unlink()
+		try:
+			self.shm.close()
+		except BufferError:
+			pass
+
+
+class LocalShells():
+	""" shell selections of one subbox as plain arrays, with the interface of SharedShells, to be sent over MPI """
+	def __init__(self, shells):
+		self.shells = shells
+
+	@classmethod
+	def from_accumulators(cls, accumulators):
+		shells = {}
+		for key, accumulator in accumulators.items():
+			ra0, dec0, zz0, aux0 = accumulator.assemble()
+			shells[key] = {"ra0": ra0, "dec0": dec0, "zz0": zz0, "aux0": aux0}
+		return cls(shells)
+
+	def attach(self):
+		pass
+
+	def shell(self, key):
+		return self.shells[key]
+
+	def release(self):
+		self.shells = {}
+
+
+class PartialShells():
+	""" shell selections of one subbox saved by the checkpoint of an earlier run, with the interface of SharedShells """
+	def __init__(self, files):
+		self.files = files
+
+	def attach(self):
+		pass
+
+	def shell(self, key):
+		with np.load(self.files[key]) as f:
+			return {col: f[col] for col in ("ra0", "dec0", "zz0", "aux0")}
+
+	def release(self):
+		pass
+
+
+class SubboxResult():
+	""" result of one subbox task: its shell selections (SharedShells, LocalShells, PartialShells, or None when the subbox
+	was not read), its number of objects and extent, and the read and compute times and cache use of the task """
+	def __init__(self, shells, ngal, extent=None, times=(0., 0.), cache_hit=None, reused=None, cached=()):
+		self.shells    = shells
+		self.ngal      = ngal
+		self.extent    = extent
+		self.times     = times
+		self.cache_hit = cache_hit
+		self.reused    = reused
+		self.cached    = cached
+
+
+class SubboxStats():
+	""" read and compute times and cache use summed over the subbox tasks run by a process """
+	def __init__(self):
+		self.read_time    = 0.
+		self.compute_time = 0.
+		self.cache_hits   = {True: 0, False: 0}
+		self.reused       = {"reads": 0, "hits": 0, "bytes": 0}
+
+	def add(self, result):
+		self.read_time    += result.times[0]
+		self.compute_time += result.times[1]
+		if result.cache_hit is not None:
+			self.cache_hits[result.cache_hit] += 1
+		if result.reused is not None:
+			self.reused["reads"] += 1
+			self.reused["hits"]  += result.reused > 0
+			self.reused["bytes"] += result.reused
+
+
 class Paths():
 	def __init__(self, config_file, args, in_part_path, input_name, out_part_path, output_name):
 		config     = configparser.ConfigParser()
@@ -51,25 +634,265 @@ class Paths():
 
 		self.input_file       = self.dir_in + self.in_part_path + self.input_name		
 		self.output_file      = self.shells_out_path + self.output_name
+		self.store_file       = self.shells_out_path + self.output_name.format(snapshot="all", shellnum="all")
+
+		### The shells are read back from the directory of the shell files, or from the shell store
+		if config.get('sim', 'shell_layout', fallback='files') == "store":
+			self.shells_path  = self.store_file
+		else:
+			self.shells_path  = self.shells_out_path
 
 	def create_outpath(self):
 		out_path = self.dir_out + "/"+ self.out_part_path
-		if not os.path.exists(out_path):
-			os.makedirs(out_path)
+		os.makedirs(out_path, exist_ok=True)
 		return out_path
 
 
+class SubboxExtents():
+	""" spatial extent and number of objects of every input subbox, recorded the first time it is read """
+	def __init__(self, extents_file):
+		self.extents_file = extents_file
+		self.extents      = {}
+		if os.path.isfile(extents_file):
+			with open(extents_file, "r") as f:
+				self.extents = json.load(f)
+
+	@staticmethod
+	def stat(infile):
+		""" os.stat of infile, or of the metadata of its raw columns if only those are left; None if there is neither """
+		for filename in (infile, os.path.join(columns_dir(infile), "meta.json")):
+			if os.path.isfile(filename):
+				return os.stat(filename)
+		return None
+
+	def get(self, infile):
+		""" the record of infile, or None if it is unknown or the file has changed since """
+		record = self.extents.get(infile)
+		stat   = self.stat(infile)
+		if record is None or stat is None:
+			return None
+		if record["mtime"] != stat.st_mtime or record["size"] != stat.st_size:
+			return None
+		return record
+
+	def update(self, infile, extent, ngalbox):
+		stat = self.stat(infile)
+		if stat is None:
+			return
+		lower, upper = (None, None) if extent is None else (list(map(float, extent[0])), list(map(float, extent[1])))
+		self.extents[infile] = {"lower": lower, "upper": upper, "ngal": int(ngalbox), "mtime": stat.st_mtime, "size": stat.st_size}
+
+	def save(self):
+		with open(self.extents_file + "_tmp", "w") as f:
+			json.dump(self.extents, f, indent=1)
+		os.rename(self.extents_file + "_tmp", self.extents_file)
+
+
+class Checkpoint():
+	""" partial results of every (shell, subbox), saved as soon as the subbox is done, so that an interrupted run
+	only computes the subboxes its shells are missing. A partial is a .npz file, written to a _tmp file and renamed,
+	and removed once its shell has been written. It is keyed by the path, mtime and size of the subbox, the range of the shell
+	and a hash of the settings the selections depend on, so that the partials of a run with other settings are not used. """
+	def __init__(self, directory, settings):
+		self.directory = directory
+		self.settings  = hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+		os.makedirs(directory, exist_ok=True)
+
+	def filename(self, out_file_name, subbox):
+		return os.path.join(self.directory, os.path.basename(out_file_name) + f".sub{subbox}.npz")
+
+	def key(self, infile, chilow, chiupp):
+		stat = SubboxExtents.stat(infile)
+		return None if stat is None else np.array([stat.st_mtime, stat.st_size, chilow, chiupp], dtype=np.float64)
+
+	def save(self, out_file_name, subbox, infile, chilow, chiupp, shell, ngalbox, extent):
+		filename     = self.filename(out_file_name, subbox)
+		filename_tmp = filename + f"_tmp{os.getpid()}"
+		extent = np.zeros((0, 3)) if extent is None else np.array(extent, dtype=np.float64)
+		with open(filename_tmp, "wb") as f:
+			np.savez(f, infile=infile, key=self.key(infile, chilow, chiupp), settings=self.settings, ngal=ngalbox, extent=extent, **shell)
+		os.rename(filename_tmp, filename)
+
+	def find(self, out_file_name, subbox, infile, chilow, chiupp):
+		""" (filename, ngalbox, extent) of the partial of the subbox infile for the shell [chilow, chiupp], or None if there
+		is none, or infile or the settings have changed since. The columns are only read by PartialShells, when the shell is written. """
+		filename = self.filename(out_file_name, subbox)
+		if not os.path.isfile(filename):
+			return None
+		key = self.key(infile, chilow, chiupp)
+		with np.load(filename) as f:
+			if str(f["infile"]) != infile or key is None or "key" not in f or not np.array_equal(f["key"], key):
+				return None
+			if "settings" not in f or str(f["settings"]) != self.settings:
+				return None
+			extent = None if len(f["extent"]) == 0 else (f["extent"][0], f["extent"][1])
+			return filename, int(f["ngal"]), extent
+
+	def sweep(self):
+		""" removes the _tmp files of the partials that were being written when an earlier run was interrupted """
+		for name in os.listdir(self.directory):
+			if "_tmp" in name:
+				os.remove(os.path.join(self.directory, name))
+
+	def remove(self, out_file_name, n_subboxes):
+		for subbox in range(n_subboxes):
+			try:
+				os.remove(self.filename(out_file_name, subbox))
+			except FileNotFoundError:
+				pass
+
+
+class InputCache():
+	""" uncompressed copies of compressed subbox tables on local scratch, one .npy file per column, keyed by path, mtime and size.
+	The least recently used entries are removed once the cache holds more than max_bytes. """
+	def __init__(self, cache_dir, max_bytes):
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		os.makedirs(cache_dir, exist_ok=True)
+
+	def entry(self, infile):
+		stat = os.stat(infile)
+		key  = hashlib.sha1(f"{os.path.abspath(infile)} {stat.st_mtime!r} {stat.st_size}".encode()).hexdigest()
+		return os.path.join(self.cache_dir, key)
+
+	def files(self, infile, columns):
+		""" the files that hold the given columns of infile: those of the cache if it is there, infile otherwise """
+		try:
+			entry = self.entry(infile)
+		except OSError:
+			return [infile]
+		if not os.path.isfile(os.path.join(entry, "meta.json")):
+			return [infile]
+		return [os.path.join(entry, col + ".npy") for col in columns]
+
+	def load(self, infile, columns, mmap_mode=None):
+		""" the given columns of infile from the cache, or None if they are not there """
+		try:
+			entry = self.entry(infile)
+			data  = load_columns(entry, columns, mmap_mode=mmap_mode)
+			os.utime(os.path.join(entry, "meta.json"))                          # most recently used
+		except (OSError, ValueError):
+			return None                                                         # not cached, or evicted meanwhile
+		return data
+
+	def store(self, infile, table):
+		""" writes all the columns of the FITS table read from infile into the cache, then makes room for it """
+		entry = self.entry(infile)
+		write_columns(table, entry, infile)
+		return self.evict(keep=entry)
+
+	def evict(self, keep=None):
+		""" removes the least recently used entries until the cache fits in max_bytes; returns the number of bytes removed """
+		entries = []
+		for name in os.listdir(self.cache_dir):
+			meta_file = os.path.join(self.cache_dir, name, "meta.json")
+			try:
+				with open(meta_file, "r") as f:
+					nbytes = json.load(f)["nbytes"]
+				entries.append((os.stat(meta_file).st_mtime, nbytes, os.path.join(self.cache_dir, name)))
+			except (OSError, ValueError, KeyError):
+				continue                                                        # being written or removed
+
+		total   = sum(entry[1] for entry in entries)
+		removed = 0
+		for used, nbytes, entry in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			if entry == keep or not remove_columns(entry):
+				continue
+			total   -= nbytes
+			removed += nbytes
+		return removed
+
+
+class SubboxCache():
+	""" subboxes loaded by a worker, kept in its memory for the next shells that need them; the least recently used
+	are dropped once they take more than max_bytes """
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.entries   = OrderedDict()
+		self.nbytes    = 0
+
+	def get(self, infile):
+		data = self.entries.get(infile)
+		if data is not None:
+			self.entries.move_to_end(infile)
+		return data
+
+	def put(self, infile, data):
+		nbytes = data.nbytes
+		if nbytes > self.max_bytes or infile in self.entries:
+			return
+		self.entries[infile] = data
+		self.nbytes += nbytes
+		while self.nbytes > self.max_bytes:
+			infile_old, data_old = self.entries.popitem(last=False)
+			self.nbytes -= data_old.nbytes
+
+	def keys(self):
+		return list(self.entries)
+
+
 class LightCone():
 	def __init__(self, config_file, args):
 		config     = configparser.ConfigParser()
 		config.read(config_file)
 
 		self.file_camb      = config.get('dir', 'file_camb')
+		self.distance_cache = config.get('dir', 'distance_cache', fallback=os.path.join(os.path.dirname(self.file_camb), "distance_tables"))
 		self.box_length     = config.getint('sim', 'box_length')
 		self.shellwidth     = config.getint('sim', 'shellwidth')
 		self.zmin           = config.getfloat('sim', 'zmin')
 		self.zmax           = config.getfloat('sim', 'zmax')
 		self.rotate         = config.getboolean('sim', 'rotate')
+		self.distance_tol   = config.getfloat('sim', 'distance_table_tol', fallback=1e-8)
+		self.float32        = config.getboolean('sim', 'float32', fallback=False)
+		self.backend        = config.get('sim', 'backend', fallback='numexpr')
+		self.replica_batch  = config.getint('sim', 'replica_batch', fallback=2**20)
+		self.cell_size      = config.getfloat('sim', 'cell_size', fallback=0)
+		self.read_ahead     = config.getint('sim', 'read_ahead', fallback=4)
+		self.write_behind   = config.getint('sim', 'write_behind', fallback=2)
+		self.chunk_size     = config.getint('sim', 'chunk_size', fallback=0)
+		self.memmap_input   = config.getboolean('sim', 'memmap_input', fallback=True)
+		self.shell_filters  = ShellFilters.from_config(config)
+
+		### With single_read, every subbox is read once for runs of up to single_read_shells consecutive shells of a snapshot,
+		### whose results all stay in memory until the last of them is written
+		self.single_read        = getattr(args, "single_read", False) or config.getboolean('sim', 'single_read', fallback=False)
+		self.single_read_shells = config.getint('sim', 'single_read_shells', fallback=8)
+		if self.single_read_shells < 1:
+			print("ERROR: single_read_shells has to be at least 1.")
+			os._exit(1)
+
+		### Shells are written to a file each, or all into a single shell store per realization
+		self.shell_layout   = config.get('sim', 'shell_layout', fallback='files')
+		if self.shell_layout not in ("files", "store"):
+			print(f"ERROR: Unknown shell_layout {self.shell_layout}. You should choose between: files or store.")
+			os._exit(1)
+		self.store = None
+
+		### The partial results of every (shell, subbox) are kept on disk until the shell is written
+		self.checkpoint_partials = config.getboolean('sim', 'checkpoint', fallback=False)
+		self.checkpoint = None
+
+		### Every worker keeps the subboxes it has read in memory, up to subbox_cache_size GiB
+		subbox_cache_size = config.getfloat('sim', 'subbox_cache_size', fallback=0.)
+		self.subbox_cache = SubboxCache(int(subbox_cache_size * 2**30)) if subbox_cache_size > 0 else None
+
+		### Compressed subboxes are decompressed once into a cache on local scratch
+		self.input_cache = None
+		input_cache_dir  = config.get('dir', 'input_cache', fallback=None)
+		if input_cache_dir:
+			input_cache_size = config.getfloat('sim', 'input_cache_size', fallback=100.)
+			self.input_cache = InputCache(os.path.expandvars(input_cache_dir), int(input_cache_size * 2**30))
+
+		self.mpi = getattr(args, "mpi", False)
+		self.shared_memory = not self.mpi
+		self.segment_owner = os.getpid()
+
+		### --dry_run writes the plan of the run into the --plan file, which a run without --dry_run then follows
+		self.plan_file = getattr(args, "plan", None)
+		self.dry_run   = getattr(args, "dry_run", False)
 
 		self.mock_random_ic = args.mock_random_ic
 		if self.mock_random_ic is None:
@@ -78,74 +901,167 @@ class LightCone():
 		self.origin  = [0, 0, 0]
 		self.clight  = 299792458.
 
-		self.h, self.results = self.run_camb()
+		if self.backend not in ("numexpr", "numba"):
+			print(f"ERROR: Unknown backend {self.backend}. You should choose between: numexpr or numba.")
+			os._exit(1)
+		if self.backend == "numba" and fused_kernel.numba is None:
+			print("WARNING: numba is not installed, falling back to the numexpr backend.")
+			self.backend = "numexpr"
+
+		### Only comoving distances are needed: background-only cosmology, cached on disk.
+		### The outermost shell may end up to two shell widths beyond zmax.
+		self.distances = load_distance_table(self.file_camb, self.zmax, 2 * self.shellwidth, tol=self.distance_tol, cache_dir=self.distance_cache)
+		self.h = self.distances.h
+
 		file_alist     =  config.get('dir','file_alist')
 		self.alist = np.loadtxt(file_alist)
 
 		rotation_matrix_instance = RotationMatrix(config_file, args)
 		self.rotation_matrix = rotation_matrix_instance.rotation_matrix
 
+		### Replica culling relies on the rotation preserving distances to the observer
+		matrix = np.reshape(self.rotation_matrix, (3, 3))
+		if self.rotate and not np.allclose(matrix @ matrix.T, np.eye(3)):
+			print("ERROR: The rotation matrix is not orthonormal.")
+			os._exit(1)
 
-	def run_camb(self):
-		#Load all parameters from camb file
-		pars = camb.read_ini(self.file_camb)
-		h    = pars.h
-		pars.set_for_lmax(2000, lens_potential_accuracy=3)
-		pars.set_matter_power(redshifts=[0.], kmax=200.0)
-		pars.NonLinearModel.set_params(halofit_version='takahashi')
-		camb.set_feedback_level(level=100)
-		results   = camb.get_results(pars)
-		return h, results
+		### Compile the kernels once here, so that the forked workers do not have to
+		if self.backend == "numba":
+			self.fused_tile_selections(self.warmup_data(), np.zeros((1, 3)), 0, 1)
 
 
 	def compute_shellnums(self):
-		shellnum_min = int(self.results.comoving_radial_distance(self.zmin) * self.h // self.shellwidth)
-		shellnum_max = int(self.results.comoving_radial_distance(self.zmax) * self.h // self.shellwidth + 1)
+		shellnum_min = int(self.distances.comoving_distance(self.zmin) // self.shellwidth)
+		shellnum_max = int(self.distances.comoving_distance(self.zmax) // self.shellwidth + 1)
 		shellnums = list(range(shellnum_min, shellnum_max+1))
 		print(f"INFO: There are {len(shellnums)} shells.")
 		return shellnums
 
 
-	def checkslicehit(self, chilow, chihigh, xx, yy, zz):
-		""" pre-select so that we're not loading non-intersecting blocks """
+	def replica_distance_range(self, tiles, extent=None):
+		""" Exact minimum and maximum distance from the observer of the replicas (N x 3 tile offsets)
+		of the box, or of the (lower, upper) extent of a subbox within it.
+		The rotation is orthonormal and applied around the observer, so the distances
+		of the rotated replica are those of the translated, unrotated one. """
 		box_length = self.box_length
-		origin = self.origin
-		bvx = np.array([0, box_length, box_length, 0,    0,    box_length, box_length, 0])
-		bvy = np.array([0,    0, box_length, box_length, 0,    0,    box_length, box_length])
-		bvz = np.array([0,    0,   0,  0,    box_length, box_length, box_length, box_length])
-
-		boo = 0
-		r   = np.zeros(8)
-		for i in range(0, 8):
-			sx   = (bvx[i] - origin[0] + box_length * xx)
-			sy   = (bvy[i] - origin[1] + box_length * yy)
-			sz   = (bvz[i] - origin[2] + box_length * zz)
-			r[i] = np.sqrt(sx * sx + sy * sy + sz * sz)
-		if chihigh < np.min(r):
-			boo = boo + 1
-		if chilow > np.max(r):
-			boo = boo+1
-
-		if boo == 0:
-			return True
-		else:
-			return False
+		if extent is None:
+			extent = ([0, 0, 0], [box_length, box_length, box_length])
+		lower = box_length * tiles + np.asarray(extent[0]) - np.asarray(self.origin)
+		upper = box_length * tiles + np.asarray(extent[1]) - np.asarray(self.origin)
 
+		nearest  = np.clip(0, lower, upper)
+		farthest = np.maximum(np.abs(lower), np.abs(upper))
+		dmin = np.sqrt(np.sum(nearest * nearest, axis=1))
+		dmax = np.sqrt(np.sum(farthest * farthest, axis=1))
+		return dmin, dmax
 
-	def convert_xyz2rdz(self, data, prefix, chilow, chiupp):
-		""" Generates and saves a single lightcone shell """
-		clight = self.clight
+
+	def replicas(self, chilow, chiupp, extent=None):
+		""" Tile offsets of the replicas that intersect [chilow, chiupp] and the total number of replicas """
+		ntiles = int(np.ceil(chiupp / self.box_length))
+		axis   = np.arange(-ntiles, ntiles)
+		tiles  = np.stack(np.meshgrid(axis, axis, axis, indexing="ij"), axis=-1).reshape(-1, 3)
+
+		dmin, dmax = self.replica_distance_range(tiles, extent=extent)
+		hit = (chiupp >= dmin) & (chilow <= dmax)
+		return tiles[hit], len(tiles)
+
+
+	def data_extent(self, data):
+		""" (lower, upper) corners of the positions of a subbox, None if it is empty """
+		if isinstance(data, SubboxChunks):
+			return data.extent()
+		if len(data['x']) == 0:
+			return None
+		lower = [np.min(data[col]) for col in ('x', 'y', 'z')]
+		upper = [np.max(data[col]) for col in ('x', 'y', 'z')]
+		return lower, upper
+
+
+	def columns(self):
+		""" columns of the subbox tables used in the current mode """
+		aux_columns = {"mock": ['vx', 'vy', 'vz'], "random": ["id"], "ic": ["density"]}
+		return ['x', 'y', 'z'] + aux_columns.get(self.mock_random_ic, [])
+
+
+	def dtype(self):
+		""" dtype of the computation and of the RA, DEC, Z columns """
+		if self.float32:
+			return np.float32
+		return np.float64
+
+
+	def aux_dtype(self):
+		""" dtype of the auxiliary column (Z_RSD, ID or ONEplusDELTA) """
+		if self.mock_random_ic == "random":
+			return np.int64
+		return self.dtype()
+
+
+	def tile_selections(self, data, prefix, chilow, chiupp):
+		""" Yields the (ra, dec, z, aux, r) of the objects of every replica that fall in [chilow, chiupp] """
 		box_length = self.box_length
-		origin = self.origin
 
 		ntiles = int(np.ceil(chiupp / box_length))
 		print(prefix + "tiling [%dx%dx%d]" % (2 * ntiles, 2 * ntiles, 2 * ntiles))
+		extent = self.data_extent(data)
+		if extent is None:
+			return
+		tiles, ntotal = self.replicas(chilow, chiupp, extent=extent)           # Only replicas of the subbox that intersect with the shell
+		print(prefix + f"INFO: {ntotal - len(tiles)} of {ntotal} replicas culled")
 		print(prefix + 'Generating map for halos in the range [%3.f - %.3f Mpc/h]' % (chilow, chiupp))
 
+		index = None
+		if self.cell_size > 0 and self.backend != "numba":
+			index = CellIndex(data, extent, self.cell_size)
+
+		yield from self.replica_selections(data, tiles, chilow, chiupp, index=index)
+
+		if index is not None:
+			print(prefix + f"INFO: cell index of {index.ncells} cells: {index.visited} of {len(tiles) * len(data)} (replica, object) pairs visited")
+
+
+	def selections(self, data, prefix, chilow, chiupp):
+		""" tile_selections of a subbox table, or chunked_selections of a subbox read in chunks """
+		if isinstance(data, SubboxChunks):
+			return self.chunked_selections(data, prefix, chilow, chiupp)
+		return self.tile_selections(data, prefix, chilow, chiupp)
+
+
+	def chunked_selections(self, chunks, prefix, chilow, chiupp):
+		""" Same selections as tile_selections, for a subbox read in chunks of rows.
+		The selections of every chunk are kept per replica and yielded replica by replica, in the order of tile_selections. """
+		ntiles = int(np.ceil(chiupp / self.box_length))
+		print(prefix + "tiling [%dx%dx%d]" % (2 * ntiles, 2 * ntiles, 2 * ntiles))
+		print(prefix + 'Generating map for halos in the range [%3.f - %.3f Mpc/h]' % (chilow, chiupp))
+
+		selections = {}
+		for chunk in chunks:
+			extent = self.data_extent(chunk)
+			if extent is None:
+				continue
+			index = None
+			if self.cell_size > 0 and self.backend != "numba":
+				index = CellIndex(chunk, extent, self.cell_size)
+			for tile in self.replicas(chilow, chiupp, extent=extent)[0]:
+				selections.setdefault(tuple(tile), []).extend(self.replica_selections(chunk, tile[None, :], chilow, chiupp, index=index))
+
+		### Tuples of tile offsets sort in the order of the replicas
+		for tile in sorted(selections):
+			yield from selections[tile]
+
+
+	def replica_selections(self, data, tiles, chilow, chiupp, index=None):
+		""" Yields the (ra, dec, z, aux, r) of the objects of the replicas in tiles that fall in [chilow, chiupp] """
+		clight = self.clight
+
+		if self.backend == "numba":
+			yield self.fused_tile_selections(data, tiles, chilow, chiupp)
+			return
+
 		px    = data['x']
 		py    = data['y']
 		pz    =	data['z']
-		ngalbox = len(px)
 
 		if self.mock_random_ic == "mock":
 			vx    = data['vx']
@@ -160,84 +1076,170 @@ class LightCone():
 			
 		#-------------------------------------------------------------------
 
-		totra   = np.array([])
-		totdec  = np.array([])
-		totz    = np.array([])
-		tot_aux = np.array([])
-
-		[axx, axy, axz, ayx, ayy, ayz, azx, azy, azz] = self.rotation_matrix
-
-		for xx in range(-ntiles, ntiles):
-			for yy in range(-ntiles, ntiles):
-				for zz in range(-ntiles, ntiles):
+		### numexpr keeps float32 arrays in float32 only if the constants are float32 as well
+		[axx, axy, axz, ayx, ayy, ayz, azx, azy, azz] = np.asarray(self.rotation_matrix, dtype=self.dtype())
+		clight = self.dtype()(clight)
+
+		for sx_0, sy_0, sz_0, objects in self.shifted_batches(px, py, pz, tiles, chilow, chiupp, index=index):
+			if self.rotate:
+				sx = ne.evaluate("axx * sx_0 + axy * sy_0 + axz * sz_0")
+				sy = ne.evaluate("ayx * sx_0 + ayy * sy_0 + ayz * sz_0")
+				sz = ne.evaluate("azx * sx_0 + azy * sy_0 + azz * sz_0")
+			else:
+				sx = sx_0
+				sy = sy_0
+				sz = sz_0
+
+			r   = ne.evaluate("sqrt(sx * sx + sy * sy + sz * sz)")
+			sel = (r > chilow) & (r < chiupp)                              # only select halos that are within the shell
+			if objects is None:
+				idx = np.nonzero(sel)[1]                                   # object index of every selected (replica, object), replica by replica
+			else:
+				idx = objects[sel]
+
+			if idx.size!=0:
+				r  = r[sel]
+				sx = sx[sel]
+				sy = sy[sel]
+				sz = sz[sel]
+				zp = self.distances.redshift(r.astype(self.dtype(), copy=False)) # interpolated distance from position
 
-					if not self.rotate:
-						slicehit = self.checkslicehit(chilow, chiupp, xx, yy, zz)             # Check if box intersects with shell
-						if not slicehit:
-							continue
+				if self.mock_random_ic == "mock":
+					ux = sx / r
+					uy = sy / r
+					uz = sz / r
 
-					sx_0  = ne.evaluate("px - %d + box_length * xx" % origin[0])
-					sy_0  = ne.evaluate("py - %d + box_length * yy" % origin[1])
-					sz_0  = ne.evaluate("pz - %d + box_length * zz" % origin[2])
+					vx_0 = vx[idx]
+					vy_0 = vy[idx]
+					vz_0 = vz[idx]
 
 					if self.rotate:
-						sx = ne.evaluate("axx * sx_0 + axy * sy_0 + axz * sz_0")
-						sy = ne.evaluate("ayx * sx_0 + ayy * sy_0 + ayz * sz_0")
-						sz = ne.evaluate("azx * sx_0 + azy * sy_0 + azz * sz_0")
+						vx_1 = ne.evaluate("axx * vx_0 + axy * vy_0 + axz * vz_0")
+						vy_1 = ne.evaluate("ayx * vx_0 + ayy * vy_0 + ayz * vz_0")
+						vz_1 = ne.evaluate("azx * vx_0 + azy * vy_0 + azz * vz_0")
 					else:
-						sx = sx_0
-						sy = sy_0
-						sz = sz_0
-
-					r   = ne.evaluate("sqrt(sx * sx + sy * sy + sz * sz)")
-					idx = np.where((r > chilow) & (r < chiupp))[0]              # only select halos that are within the shell
-
-
-
-					if idx.size!=0:
-						zp  = self.results.redshift_at_comoving_radial_distance(r[idx] / self.h) # interpolated distance from position
-						
-						ux = sx[idx] / r[idx]
-						uy = sy[idx] / r[idx]
-						uz = sz[idx] / r[idx]
-						# zp = zi[idx]
-
-						if self.mock_random_ic == "mock":
-							vx_0 = vx[idx]
-							vy_0 = vy[idx]
-							vz_0 = vz[idx]
-
-							if self.rotate:
-								vx_1 = ne.evaluate("axx * vx_0 + axy * vy_0 + axz * vz_0")
-								vy_1 = ne.evaluate("ayx * vx_0 + ayy * vy_0 + ayz * vz_0")
-								vz_1 = ne.evaluate("azx * vx_0 + azy * vy_0 + azz * vz_0")
-							else:
-								vx_1 = vx_0
-								vy_1 = vy_0
-								vz_1 = vz_0
-
-							qx = vx_1 * 1000.
-							qy = vy_1 * 1000.
-							qz = vz_1 * 1000.
-
-							vlos    = ne.evaluate("qx * ux + qy * uy + qz * uz")
-							dz      = ne.evaluate("(vlos / clight) * (1 + zp)")
-							tot_aux = np.append(tot_aux, zp + dz)
-						elif self.mock_random_ic == "random":
-							tot_aux = np.append(tot_aux, id_[idx])
-						elif self.mock_random_ic == "ic":
-							tot_aux = np.append(tot_aux, dens[idx])
-
-						tht, phi = hp.vec2ang(np.c_[ux, uy, uz])
-						ra, dec  = tp2rd(tht, phi)
-
-						totra   = np.append(totra , ra)
-						totdec  = np.append(totdec, dec)
-						totz    = np.append(totz  , zp)
+						vx_1 = vx_0
+						vy_1 = vy_0
+						vz_1 = vz_0
+
+					qx = vx_1 * 1000.
+					qy = vy_1 * 1000.
+					qz = vz_1 * 1000.
 
+					vlos    = ne.evaluate("qx * ux + qy * uy + qz * uz")
+					dz      = ne.evaluate("(vlos / clight) * (1 + zp)")
+					aux     = zp + dz
+				elif self.mock_random_ic == "random":
+					aux = id_[idx]
+				elif self.mock_random_ic == "ic":
+					aux = dens[idx]
+
+				ra, dec = xyz2rd(sx, sy, sz)
+
+				yield ra, dec, zp, aux, r
+
+
+	def shifted_batches(self, px, py, pz, tiles, chilow, chiupp, index=None):
+		""" Positions of the objects of batches of replicas, translated to the observer, with their object indices.
+		Without an index every object of every replica is taken, as a (replica, object) array, and the indices are None. """
+		shifts = (self.box_length * tiles - np.asarray(self.origin)).astype(px.dtype.newbyteorder("="))     # exact: multiples of box_length
+
+		### Replicas are processed in batches, so that boxes that are small compared to the shells (thousands
+		### of replicas of a few 1e5 objects) do not pay the per-replica overhead thousands of times.
+		### Large subboxes have batches of a single replica.
+		if index is None:
+			batch = max(1, self.replica_batch // max(len(px), 1))
+			for first in range(0, len(tiles), batch):
+				ox = shifts[first:first + batch, 0:1]
+				oy = shifts[first:first + batch, 1:2]
+				oz = shifts[first:first + batch, 2:3]
+				yield ne.evaluate("px + ox"), ne.evaluate("py + oy"), ne.evaluate("pz + oz"), None
+			return
+
+		### With an index only the objects of the cells that may intersect the shell are visited
+		pending, size = [], 0
+		for n, shift in enumerate(shifts):
+			objects = index.candidates(shift, chilow, chiupp)
+			if objects.size != 0:
+				pending.append((shift, objects))
+				size += objects.size
+			if pending and (size >= self.replica_batch or n == len(shifts) - 1):
+				objects = np.concatenate([part for shift, part in pending])
+				offsets = np.repeat([shift for shift, part in pending], [len(part) for shift, part in pending], axis=0)
+				ox, oy, oz = offsets[:, 0], offsets[:, 1], offsets[:, 2]
+				px_c, py_c, pz_c = px[objects], py[objects], pz[objects]
+				yield ne.evaluate("px_c + ox"), ne.evaluate("py_c + oy"), ne.evaluate("pz_c + oz"), objects
+				pending, size = [], 0
+
+
+	def warmup_data(self):
+		""" a single object with the column types of the subbox files (FITS E and J columns) """
+		dtype = [(col, "f4") for col in ("x", "y", "z", "vx", "vy", "vz", "density")] + [("id", "i4")]
+		return np.zeros(1, dtype=dtype)
+
+
+	def fused_tile_selections(self, data, tiles, chilow, chiupp):
+		""" Same selection as the numexpr path, for all the replicas at once, with the compiled kernel """
+		if self.mock_random_ic == "mock":
+			mode, vel, aux_in = fused_kernel.MOCK, (data['vx'], data['vy'], data['vz']), None
+		elif self.mock_random_ic == "random":
+			mode, vel, aux_in = fused_kernel.RANDOM, None, data["id"]
+		elif self.mock_random_ic == "ic":
+			mode, vel, aux_in = fused_kernel.IC, None, data["density"]
+		else:
+			print(f"ERROR!!! generate_lc, convert_xyz2rdz: You should choose between: mock, random or ic. You have chosen {self.mock_random_ic}")
+			os._exit(1)
+
+		matrix = np.reshape(self.rotation_matrix, (3, 3)) if self.rotate else np.eye(3)
+		return fused_kernel.fused_selection(data['x'], data['y'], data['z'], vel, aux_in, mode, tiles, self.box_length, self.origin, matrix,
+		                                    chilow, chiupp, self.distances, self.clight, dtype=self.dtype(), aux_dtype=self.aux_dtype(), rotate=self.rotate)
+
+
+	def convert_xyz2rdz(self, data, prefix, chilow, chiupp):
+		""" Generates and saves a single lightcone shell """
+		accumulator, ngalbox = self.accumulate_shell(data, prefix, chilow, chiupp)
+		totra, totdec, totz, tot_aux = accumulator.assemble()
 		return totra, totdec, totz, tot_aux, ngalbox
 
 
+	def accumulate_shell(self, data, prefix, chilow, chiupp):
+		""" ShellAccumulator of the objects of a single lightcone shell """
+		ngalbox = len(data)
+
+		accumulator = ShellAccumulator(aux_dtype=self.aux_dtype(), dtype=self.dtype())
+		for ra, dec, zp, aux, r in self.selections(data, prefix, chilow, chiupp):
+			accumulator.append(ra, dec, zp, aux)
+		return accumulator, ngalbox
+
+
+	def accumulate_shells(self, data, prefix, shellnums):
+		""" ShellAccumulators {shellnum: accumulator} of several lightcone shells, from a single pass over the replicas """
+		shellwidth = self.shellwidth
+		ngalbox = len(data)
+
+		chilow = shellwidth * (min(shellnums) + 0)
+		chiupp = shellwidth * (max(shellnums) + 1)
+
+		accumulators = {shellnum: ShellAccumulator(aux_dtype=self.aux_dtype(), dtype=self.dtype()) for shellnum in shellnums}
+		for ra, dec, zp, aux, r in self.selections(data, prefix, chilow, chiupp):
+			### Route every object to its shell. Objects lying exactly on a shell edge
+			### are dropped, as the strict selection of a single shell does.
+			shell = np.floor(r / shellwidth)
+			shell[r < shellwidth * shell] -= 1
+			shell[r >= shellwidth * (shell + 1)] += 1
+			keep  = np.flatnonzero(r > shellwidth * shell)
+			if keep.size == 0:
+				continue
+
+			order = keep[np.argsort(shell[keep], kind="stable")]
+			shell = shell[order].astype(np.int64)
+			starts = np.flatnonzero(np.diff(shell)) + 1
+			for part, start in zip(np.split(order, starts), np.r_[0, starts]):
+				if shell[start] in accumulators:
+					accumulators[shell[start]].append(ra[part], dec[part], zp[part], aux[part])
+		return accumulators, ngalbox
+
+
 	def getnearestsnap(self, zmid):
 		""" get the closest snapshot """
 		# zsnap  = 1/self.alist[:,1]-1.
@@ -248,48 +1250,506 @@ class LightCone():
 
 
 	def obtain_data(self, infile, prefix):
+		""" The columns of the subbox needed in the current mode, as contiguous native-endian arrays.
+		They are memory mapped from the raw columns of the subbox (columns_dir) if it has them, or from the input cache for
+		compressed files if there is one; otherwise the rows are read raw (memory mapped for uncompressed files) and only
+		the needed columns are converted. data.cache_hit tells whether a compressed file was found in the input cache.
+		Subboxes read into memory are kept in the subbox cache of the worker, if there is one; data.reused is the number
+		of bytes that did not have to be read again (None if the subbox cannot be cached). """
+		if self.subbox_cache is not None:
+			data = self.subbox_cache.get(infile)
+			if data is not None:
+				print(prefix + f"INFO: The input file is {infile} and it has {len(data)} halos, from the memory of the worker")
+				data.cache_hit, data.reused = None, data.nbytes
+				return data
+
 		try:
-			hdul = fits.open(infile, memmap=False)
-			data = hdul[1].data
-			hdul.close()
-			ngalbox = len(data["x"])
-			print(prefix + f"INFO: The input file is {infile} and it has {ngalbox} halos")
+			mmap_mode = "r" if self.memmap_input or self.chunk_size > 0 else None
+			cached, cache_hit, source = None, None, ""
+			store = self.column_store(infile, prefix)
+			if store is not None:
+				cached = load_columns(store, self.columns(), mmap_mode=mmap_mode)
+				source = f", from {store}"
+			elif self.input_cache is not None and infile.endswith(".gz"):
+				cached, cache_hit = self.cached_input(infile, prefix, mmap_mode=mmap_mode)
+				source = ", from the input cache" if cache_hit else ""
+
+			if self.chunk_size > 0:
+				data = SubboxChunks(infile, self.chunk_size, self.columns(), cached=cached)
+				print(prefix + f"INFO: The input file is {infile} and it has {len(data)} halos, read in chunks of {self.chunk_size}{source}")
+			else:
+				if cached is not None:
+					data = cached
+				else:
+					with fits.open(infile, memmap=True) as hdul:
+						data = native_columns(hdul[1].data, self.columns())
+				print(prefix + f"INFO: The input file is {infile} and it has {len(data)} halos{source}")
 
 		except IOError:
 			print(prefix + f"WARNING: Couldn't open {infile}.", file=sys.stderr)
 			os._exit(1)
+		data.cache_hit, data.reused = cache_hit, None
+		if self.subbox_cache is not None and isinstance(data, SubboxColumns) and data.in_memory():
+			self.subbox_cache.put(infile, data)
+			data.reused = 0
 		return data
 
 
-	def generate_shell(self, infile, subbox, prefix, chilow, chiupp, return_dict):
+	def column_store(self, infile, prefix=None):
+		""" the directory of the raw columns of infile, if it has them and they match infile; stale ones are reported if prefix is given """
+		store = columns_dir(infile)
+		try:
+			with open(os.path.join(store, "meta.json"), "r") as f:
+				meta = json.load(f)
+		except (OSError, ValueError):
+			return None
+		if os.path.isfile(infile):
+			stat = os.stat(infile)
+			if meta["mtime"] != stat.st_mtime or meta["size"] != stat.st_size:
+				if prefix is not None:
+					print(prefix + f"WARNING: {store} does not match {infile} any more and is ignored.")
+				return None
+		return store
+
+
+	def cached_input(self, infile, prefix, mmap_mode=None):
+		""" (columns, hit) of a compressed subbox from the input cache, decompressed into it first if they are not there """
+		data = self.input_cache.load(infile, self.columns(), mmap_mode=mmap_mode)
+		if data is not None:
+			return data, True
+
+		start = time.perf_counter()
+		with fits.open(infile, memmap=False) as hdul:
+			table   = hdul[1].data
+			evicted = self.input_cache.store(infile, table)
+			if mmap_mode is not None:
+				data = self.input_cache.load(infile, self.columns(), mmap_mode=mmap_mode)
+			if data is None:
+				data = native_columns(table, self.columns())
+		print(prefix + f"INFO: {infile} decompressed into the input cache in {time.perf_counter() - start:.3f} s, {evicted / 2**30:.2f} GiB evicted")
+		return data, False
+
+
+	def input_files(self, infile):
+		""" the files that a worker reads for infile """
+		store = self.column_store(infile)
+		if store is not None:
+			return [os.path.join(store, col + ".npy") for col in self.columns()]
+		if self.input_cache is not None and infile.endswith(".gz"):
+			return self.input_cache.files(infile, self.columns())
+		return [infile]
+
+
+	def share_shells(self, accumulators):
+		""" results of a subbox: in shared memory for the workers of the pool, as arrays for MPI """
+		if self.shared_memory:
+			return SharedShells.from_accumulators(accumulators, self.dtype(), self.aux_dtype(), self.segment_owner)
+		return LocalShells.from_accumulators(accumulators)
+
+
+	def generate_shell(self, infile, prefix, chilow, chiupp):
 		### Read Data
+		start = time.perf_counter()
+		data = self.obtain_data(infile, prefix)
+		read_time = time.perf_counter() - start
+
+		### Convert XYZ to RA DEC Z, into shared memory
+		accumulator, ngalbox = self.accumulate_shell(data, prefix, chilow, chiupp)
+		return self.subbox_result(data, self.share_shells({None: accumulator}), ngalbox, start, read_time)
+
+
+	def generate_shell_group(self, infile, prefix, shellnums):
+		### Read Data once for all the shells of the group
+		start = time.perf_counter()
 		data = self.obtain_data(infile, prefix)
+		read_time = time.perf_counter() - start
+
+		### Convert XYZ to RA DEC Z and bin into shells, into shared memory
+		accumulators, ngalbox = self.accumulate_shells(data, prefix, shellnums)
+		return self.subbox_result(data, self.share_shells(accumulators), ngalbox, start, read_time)
+
+
+	def subbox_result(self, data, shells, ngalbox, start, read_time):
+		""" SubboxResult of a subbox task started at start that spent read_time reading the subbox data """
+		return SubboxResult(shells, ngalbox, self.data_extent(data), (read_time, time.perf_counter() - start - read_time),
+		                    data.cache_hit, data.reused, self.subbox_cache.keys() if self.subbox_cache is not None else [])
+
+
+	def subbox_tasks(self, unit, path_instance, extents, n_subboxes):
+		""" (cost, subbox, infile, prefix) of the subboxes that can contribute to the unit, largest estimated cost first.
+		Subboxes with a known extent that misses the range are not read; their entry is None. """
+		chilow, chiupp = unit["chilow"], unit["chiupp"]
+		tasks = []
+		unit["results"] = {}
+		nreplicas_box = None
+		resumed = 0
+		for subbox in range(n_subboxes):
+			infile = path_instance.input_file.format(redshift=unit["redshift"], subbox=subbox)
+			prefix = f"[{unit['label']}; subbox={subbox}]: "
+
+			### Cost: number of objects times number of replicas that intersect the range
+			record = extents.get(infile)
+			if record is not None:
+				extent = None if record["lower"] is None else (record["lower"], record["upper"])
+				nreplicas = 0 if extent is None else len(self.replicas(chilow, chiupp, extent=extent)[0])
+				if nreplicas == 0:
+					unit["results"][subbox] = SubboxResult(None, record["ngal"])
+					continue
+				cost = record["ngal"] * nreplicas
+			elif subbox in unit.get("costs", {}):
+				cost = unit["costs"][subbox]
+			else:
+				### Not read yet: about 32 bytes per object in the FITS tables, and every replica of the box
+				if nreplicas_box is None:
+					nreplicas_box = len(self.replicas(chilow, chiupp)[0])
+				cost = (os.path.getsize(infile) if os.path.isfile(infile) else 0) / 32 * nreplicas_box
+
+			### Subboxes whose partials were found before the run started are not read again
+			if subbox in unit.get("resumed", {}):
+				files, ngalbox, extent = unit["resumed"][subbox]
+				unit["results"][subbox] = SubboxResult(PartialShells(files), ngalbox, extent)
+				extents.update(infile, extent, ngalbox)
+				resumed += 1
+				continue
+
+			tasks.append((cost, subbox, infile, prefix))
+
+		print(f"INFO: [{unit['label']}]: {n_subboxes - len(tasks) - resumed} of {n_subboxes} subboxes skipped by their extent" +
+		      (f", {resumed} resumed from their partials." if self.checkpoint is not None else "."))
+		tasks.sort(key=lambda task: -task[0])
+		return tasks
+
+
+	def run_units(self, units, path_instance, extents, pool, n_subboxes, cat_seed):
+		""" Runs the (unit, subbox) tasks of all the units from a single queue, keeping every worker busy.
+		The tasks of a unit are submitted largest first, those of the next unit as soon as there is room,
+		and a unit is written out as soon as its last task has finished. A worker with room for a task
+		gets a waiting task close to the front whose subbox it is about to read, or holds in its subbox cache,
+		if there is one. """
+		read_ahead   = ReadAhead(self.read_ahead, resolve=self.input_files)
+		write_behind = WriteBehind(self.write_behind, abort=pool.abort)
+		stats        = SubboxStats()
+		wait_time    = 0.
+
+		waiting  = deque()
+		running  = {}
+		inflight = [0] * pool.nproc
+		held     = [set() for worker in range(pool.nproc)]                      # subboxes in the cache of every worker
+		queued   = [[] for worker in range(pool.nproc)]                         # and those of its running tasks
+		next_unit = 0
+		while next_unit < len(units) or waiting or running:
+			### Keep the workers busy, with a task waiting behind the running one so that none of them goes idle
+			while min(inflight) < 2 and (waiting or next_unit < len(units)):
+				if not waiting:
+					unit = units[next_unit]
+					next_unit += 1
+					tasks = self.subbox_tasks(unit, path_instance, extents, n_subboxes)
+					unit["pending"] = len(tasks)
+					if unit["pending"] == 0:
+						self.finish_unit(unit, extents, n_subboxes, cat_seed, write_behind)
+					waiting.extend((unit, subbox, infile, prefix) for cost, subbox, infile, prefix in tasks)
+					continue
+
+				worker = inflight.index(min(inflight))
+				files    = [task[2] for task in list(waiting)[:2 * pool.nproc]]
+				position = next((files.index(infile) for infile in reversed(queued[worker]) if infile in files), None)    # last read first
+				if position is None:
+					position = next((i for i, infile in enumerate(files) if infile in held[worker]), 0)
+				unit, subbox, infile, prefix = waiting[position]
+				del waiting[position]
+				future = pool.submit(worker, unit["target"], infile, prefix, unit["shell_args"])
+				running[future] = (unit, subbox, infile, worker)
+				inflight[worker] += 1
+				queued[worker].append(infile)
+				read_ahead.request([infile] + [task[2] for task in list(waiting)[:self.read_ahead]])
+
+			if not running:
+				continue
+			start = time.perf_counter()
+			done, not_done = wait(running, return_when=FIRST_COMPLETED)
+			wait_time += time.perf_counter() - start
+			for future in done:
+				unit, subbox, infile, worker = running.pop(future)
+				inflight[worker] -= 1
+				queued[worker].remove(infile)
+				result = unit["results"][subbox] = pool.result(future)
+				held[worker]  = set(result.cached)
+				result.cached = None
+				result.shells.attach()
+				stats.add(result)
+				extents.update(infile, result.extent, result.ngal)
+				if self.checkpoint is not None:
+					write_behind.submit(self.save_partials, unit, subbox, infile, result)
+
+				unit["pending"] -= 1
+				if unit["pending"] == 0:
+					self.finish_unit(unit, extents, n_subboxes, cat_seed, write_behind)
+
+		read_ahead.close()
+		write_behind.close()
+		print(f"INFO: Workers: {stats.read_time:.3f} s reading subboxes, {stats.compute_time:.3f} s computing; {wait_time:.3f} s waiting for them.")
+		if self.input_cache is not None:
+			print(f"INFO: Input cache: {stats.cache_hits[True]} subboxes read from it, {stats.cache_hits[False]} decompressed into it.")
+		if self.subbox_cache is not None:
+			self.report_subbox_cache(stats.reused)
+
+
+	def run_units_mpi(self, units, path_instance, extents, n_subboxes, cat_seed):
+		""" Runs the units on the ranks of MPI.COMM_WORLD. The subbox tasks of every unit are spread over the ranks,
+		largest first to the least loaded rank, and their results are gathered on the rank that writes the unit.
+		With a subbox cache, a subbox goes back to the rank that read it last, unless that rank is already a task ahead. """
+		from mpi4py import MPI
+
+		comm = MPI.COMM_WORLD
+		rank = comm.Get_rank()
+		size = comm.Get_size()
+		stats     = SubboxStats()
+		wait_time = 0.
+		last_rank = {}
+
+		for n, unit in enumerate(units):
+			### Every rank makes the same assignment: same extents, same costs
+			tasks = self.subbox_tasks(unit, path_instance, extents, n_subboxes)
+			load  = np.zeros(size)
+			local = {}
+			for cost, subbox, infile, prefix in tasks:
+				task_rank = int(np.argmin(load))
+				if self.subbox_cache is not None and infile in last_rank and load[last_rank[infile]] < load[task_rank] + max(cost, 1):
+					task_rank = last_rank[infile]
+				load[task_rank] += max(cost, 1)
+				last_rank[infile] = task_rank
+				if task_rank == rank:
+					result = local[subbox] = getattr(self, unit["target"])(infile, prefix, *unit["shell_args"])
+					result.cached = None
+					stats.add(result)
+					if self.checkpoint is not None:
+						self.save_partials(unit, subbox, infile, result)
+
+			start = time.perf_counter()
+			owner = n % size
+			parts = self.gather_results(comm, local, owner)
+
+			### Every rank records the extents of all the subboxes read, so that all of them skip the same subboxes later on
+			read = {infile: (local[subbox].extent, local[subbox].ngal) for cost, subbox, infile, prefix in tasks if subbox in local}
+			for records in comm.allgather(read):
+				for infile, (extent, ngalbox) in records.items():
+					extents.update(infile, extent, ngalbox)
+			wait_time += time.perf_counter() - start
+
+			results = unit.pop("results")
+			if rank == owner:
+				results.update(parts)
+				self.save_unit(unit, results, n_subboxes, cat_seed)
+			if rank == 0:
+				extents.save()
+
+		times = comm.gather((stats.read_time, stats.compute_time, wait_time), root=0)
+		hits  = comm.gather(stats.cache_hits, root=0)
+		reuse = comm.gather(stats.reused, root=0)
+		if rank == 0:
+			print(f"INFO: MPI: {size} ranks, " + ", ".join(f"rank {r}: {t[0]:.3f} s reading, {t[1]:.3f} s computing, {t[2]:.3f} s waiting" for r, t in enumerate(times)) + ".")
+			if self.input_cache is not None:
+				print(f"INFO: Input cache: {sum(h[True] for h in hits)} subboxes read from it, {sum(h[False] for h in hits)} decompressed into it.")
+			if self.subbox_cache is not None:
+				self.report_subbox_cache({key: sum(r[key] for r in reuse) for key in stats.reused})
+
+
+	def gather_results(self, comm, local, owner, chunk_bytes=2**30):
+		""" the {subbox: SubboxResult} of all the ranks on the rank owner, None on the others. Only the results without
+		their arrays are pickled: the pickled collectives of mpi4py fail beyond 2 GiB, so that the shell arrays are sent
+		as buffers, in messages of at most chunk_bytes """
+		from mpi4py import MPI
+
+		columns = ("ra0", "dec0", "zz0", "aux0")
+		header  = {}
+		for subbox, result in local.items():
+			layout = {key: [(shell[col].dtype.str, len(shell[col])) for col in columns] for key, shell in result.shells.shells.items()}
+			header[subbox] = (SubboxResult(None, result.ngal, result.extent, result.times, result.cache_hit, result.reused), layout)
+		headers = comm.gather(header, root=owner)
+
+		if comm.Get_rank() != owner:
+			for subbox, result in local.items():
+				for key, shell in result.shells.shells.items():
+					for col in columns:
+						buffer = np.ascontiguousarray(shell[col]).view(np.uint8)
+						for start in range(0, len(buffer), chunk_bytes):
+							comm.Send([buffer[start:start + chunk_bytes], MPI.BYTE], dest=owner)
+			return None
+
+		### The arrays of every rank arrive in the order of its header
+		results = {}
+		for source, header in enumerate(headers):
+			if source == owner:
+				results.update(local)
+				continue
+			for subbox, (result, layout) in header.items():
+				shells = {}
+				for key, shell_layout in layout.items():
+					shells[key] = {}
+					for col, (dtype, count) in zip(columns, shell_layout):
+						array  = np.empty(count, dtype=dtype)
+						buffer = array.view(np.uint8)
+						for start in range(0, len(buffer), chunk_bytes):
+							comm.Recv([buffer[start:start + chunk_bytes], MPI.BYTE], source=source)
+						shells[key][col] = array
+				result.shells = LocalShells(shells)
+				results[subbox] = result
+		return results
+
+
+	def report_subbox_cache(self, reused):
+		hit_rate = reused["hits"] / reused["reads"] if reused["reads"] else 0.
+		print(f"INFO: Subbox cache: {reused['hits']} of {reused['reads']} subboxes found in the memory of the worker ({100 * hit_rate:.1f}%), {reused['bytes'] / 2**30:.2f} GiB not read again.")
+
+
+	def finish_unit(self, unit, extents, n_subboxes, cat_seed, write_behind):
+		""" Hands the shells of a unit over to the writer once all its subboxes are done """
+		results = unit.pop("results")
+		write_behind.submit(self.save_unit, unit, results, n_subboxes, cat_seed)
+		extents.save()
+
+
+	def save_unit(self, unit, results, n_subboxes, cat_seed):
+		""" Writes the shells of a unit and frees the shared memory of its subboxes """
+		counter_ngal = sum(results[subbox].ngal for subbox in range(n_subboxes))
+		for shellnum, out_file_name, key in unit["shells"]:
+			subbox_shells = [results[subbox].shells.shell(key) if results[subbox].shells is not None else self.empty_shell() for subbox in range(n_subboxes)]
+			self.save_shell(out_file_name, subbox_shells, counter_ngal, shellnum, unit["snapshot"], cat_seed)
+			del subbox_shells
+			if self.checkpoint is not None:
+				self.checkpoint.remove(out_file_name, n_subboxes)
+		self.release_subboxes(results, n_subboxes)
+
+
+	def resumed_subboxes(self, unit, path_instance, n_subboxes):
+		""" {subbox: (files, ngalbox, extent)} of the subboxes whose partials of all the shells of the unit were saved by an earlier run """
+		resumed = {}
+		for subbox in range(n_subboxes):
+			infile = path_instance.input_file.format(redshift=unit["redshift"], subbox=subbox)
+			partials = [self.checkpoint.find(out_file_name, subbox, infile, *self.shell_range(shellnum)) for shellnum, out_file_name, key in unit["shells"]]
+			if all(partial is not None for partial in partials):
+				files = {key: partial[0] for (shellnum, out_file_name, key), partial in zip(unit["shells"], partials)}
+				resumed[subbox] = (files, partials[0][1], partials[0][2])
+		return resumed
+
+
+	def save_partials(self, unit, subbox, infile, result):
+		""" saves the SubboxResult of a subbox for every shell of the unit """
+		for shellnum, out_file_name, key in unit["shells"]:
+			self.checkpoint.save(out_file_name, subbox, infile, *self.shell_range(shellnum), result.shells.shell(key), result.ngal, result.extent)
+
 
-		### Convert XYZ to RA DEC Z
-		ra0, dec0, zz0, aux0, ngalbox = self.convert_xyz2rdz(data, prefix, chilow, chiupp)
+	def shell_range(self, shellnum):
+		""" (chilow, chiupp) of the shell shellnum """
+		return self.shellwidth * shellnum, self.shellwidth * (shellnum + 1)
 
 
-		shell_subbox_dict = {"ra0": ra0, "dec0": dec0, "zz0": zz0, "aux0": aux0}
-		return_dict[subbox] = shell_subbox_dict
+	def release_subboxes(self, results, n_subboxes):
+		""" frees the shared memory of the subbox results """
+		for subbox in range(n_subboxes):
+			if results[subbox].shells is not None:
+				results[subbox].shells.release()
 
-		return_dict["NGAL" + str(subbox)] = ngalbox
 
+	def empty_shell(self):
+		dtype = self.dtype()
+		return {"ra0": np.zeros(0, dtype=dtype), "dec0": np.zeros(0, dtype=dtype), "zz0": np.zeros(0, dtype=dtype), "aux0": np.zeros(0, dtype=self.aux_dtype())}
 
-	def generate_shells(self, path_instance, snapshot=None, redshift=None, cutsky=True, nproc=5, n_subboxes=27, cat_seed=None):
+
+	def save_shell(self, out_file_name, subbox_shells, counter_ngal, shellnum, snapshot, cat_seed):
+		""" Writes the subbox results of one shell into the shell file, or into the shell store """
+		if self.store is not None:
+			self.store.write_shell(shellnum, lambda group: self.fill_shell(group, subbox_shells, counter_ngal, shellnum, snapshot, cat_seed))
+			return
+
+		out_file_name_tmp  = out_file_name + "_tmp"
+
+		with h5py.File(out_file_name_tmp, 'w') as out_file:
+			self.fill_shell(out_file, subbox_shells, counter_ngal, shellnum, snapshot, cat_seed)
+
+		os.rename(out_file_name_tmp, out_file_name)
+
+
+	def fill_shell(self, out_file, subbox_shells, counter_ngal, shellnum, snapshot, cat_seed):
+		""" Fills a shell file, or the group of a shell in the store, subbox by subbox """
+		### Count the number of galaxies per shell
+		n_gal_shell_all_subboxes = 0
+		for shell_subbox_dict in subbox_shells:
+			n_gal_shell_all_subboxes += len(shell_subbox_dict["ra0"])
+
+		out_file.create_group('galaxy')
+		options   = self.shell_filters.options(n_gal_shell_all_subboxes)
+		ra0_dset  = out_file.create_dataset('galaxy/RA',      shape=(n_gal_shell_all_subboxes,), dtype=np.float32, **options)
+		dec0_dset = out_file.create_dataset('galaxy/DEC',     shape=(n_gal_shell_all_subboxes,), dtype=np.float32, **options)
+		zz0_dset  = out_file.create_dataset('galaxy/Z_COSMO', shape=(n_gal_shell_all_subboxes,), dtype=np.float32, **options)
+
+		if self.mock_random_ic == "mock":
+			aux0_dset = out_file.create_dataset('galaxy/Z_RSD',   shape=(n_gal_shell_all_subboxes,), dtype=np.float32, **options)
+		elif self.mock_random_ic == "random":
+			aux0_dset = out_file.create_dataset('galaxy/ID',      shape=(n_gal_shell_all_subboxes,), dtype=np.int32, **options)
+		elif self.mock_random_ic == "ic":
+			aux0_dset = out_file.create_dataset('galaxy/ONEplusDELTA', shape=(n_gal_shell_all_subboxes,), dtype=np.float32, **options)
+
+		### Fill the datasets straight from the subbox arrays. Chunked datasets are written
+		### a column at a time instead, so that no compressed chunk is written twice.
+		if self.shell_filters.chunked:
+			ra0_dset[...]  = self.shell_column(subbox_shells, "ra0", np.float32)
+			dec0_dset[...] = self.shell_column(subbox_shells, "dec0", np.float32)
+			zz0_dset[...]  = self.shell_column(subbox_shells, "zz0", np.float32)
+			aux0_dset[...] = self.shell_column(subbox_shells, "aux0", aux0_dset.dtype)
+		else:
+			index_i = 0
+			index_f = 0
+			for shell_subbox_dict in subbox_shells:
+				index_f = index_i + len(shell_subbox_dict["ra0"])
+				if index_f == index_i:
+					continue
+
+				ra0_dset[index_i: index_f]  = shell_subbox_dict["ra0"].astype(np.float32, copy=False)
+				dec0_dset[index_i: index_f] = shell_subbox_dict["dec0"].astype(np.float32, copy=False)
+				zz0_dset[index_i: index_f]  = shell_subbox_dict["zz0"].astype(np.float32, copy=False)
+
+				if self.mock_random_ic == "ic":
+					aux0_dset[index_i: index_f] = (1 + shell_subbox_dict["aux0"]).astype(np.float32, copy=False)
+				else:
+					aux0_dset[index_i: index_f] = shell_subbox_dict["aux0"].astype(aux0_dset.dtype, copy=False)
+
+				index_i = index_f
+
+		out_file.attrs['NGAL']     = counter_ngal
+		out_file.attrs['SHELLNUM'] = shellnum
+		out_file.attrs['SNAPSHOT'] = snapshot
+		out_file.attrs['CAT_SEED'] = cat_seed
+		out_file.attrs['BOX_LENGTH'] = self.box_length
+
+
+	def shell_column(self, subbox_shells, key, dtype):
+		""" a column of the shell, from all its subboxes, as written in the shell file """
+		column = np.concatenate([shell[key] for shell in subbox_shells])
+		if key == "aux0" and self.mock_random_ic == "ic":
+			column = 1 + column
+		return column.astype(dtype, copy=False)
+
+
+	def shell_units(self, path_instance, snapshot, redshift, cutsky, single_read, done):
+		""" (units, number of replicas, number of replicas culled) of the shells of the run, without those for which done(shellnum, out_file_name) """
 		shellnums = self.compute_shellnums()
+		shell_groups = {}
+		n_replicas, n_culled = 0, 0
+		units = []
 		for shellnum in shellnums:
 			chilow = self.shellwidth * (shellnum + 0)
 			chiupp = self.shellwidth * (shellnum + 1)
 			chimid = 0.5 * (chilow + chiupp)
 
 			# Check whether the minimum redshift of the shell is outside the redshift range of interest 
-			zlow = self.results.redshift_at_comoving_radial_distance(chilow / self.h)
+			zlow = self.distances.redshift(chilow)
 			if zlow > self.zmax:
 				continue
 
 			if not cutsky:
 				print("Light-cone")
-				zmid = self.results.redshift_at_comoving_radial_distance(chimid / self.h)
+				zmid = self.distances.redshift(chimid)
 				nearestsnap, nearestred = self.getnearestsnap(zmid)
 				
 				snapshot = nearestsnap
@@ -298,76 +1758,296 @@ class LightCone():
 			out_file_name = path_instance.output_file.format(snapshot=snapshot, shellnum=str(shellnum))
 
 			# Don't reprocess files already done
-			if os.path.isfile(out_file_name):
+			if done(shellnum, out_file_name):
 				continue
 
-			jobs = []
-			manager = mp.Manager()
-			return_dict = manager.dict()
-			counter = 0
-			for subbox in range(n_subboxes):
-				infile = path_instance.input_file.format(redshift=redshift, subbox=subbox)
-				prefix = f"[shellnum={shellnum}; subbox={subbox}]: "
-
-				p = mp.Process(target=self.generate_shell, args=(infile, subbox, prefix, chilow, chiupp, return_dict))
-				jobs.append(p)
-				p.start()
-				counter = counter + 1
-				if (counter == nproc) or (subbox == n_subboxes - 1):
-					for proc in jobs:
-						proc.join()
-					counter = 0
-					jobs = []
-
-			### Count the number of galaxies per shell
-			n_gal_shell_all_subboxes = 0
-			for subbox in range(n_subboxes):
-				shell_subbox_dict = return_dict[subbox]
-				n_gal_shell_all_subboxes += len(shell_subbox_dict["ra0"])
+			if single_read:
+				shell_groups.setdefault((snapshot, redshift), []).append(shellnum)
+				continue
 
-			### Declare arrays of size
-			ra0_array = np.zeros(n_gal_shell_all_subboxes)
-			dec0_array = np.zeros(n_gal_shell_all_subboxes)
-			zz0_array = np.zeros(n_gal_shell_all_subboxes)
-			
-			aux0_array = np.zeros(n_gal_shell_all_subboxes)
-			counter_ngal = 0
+			tiles, ntotal = self.replicas(chilow, chiupp)
+			n_replicas += ntotal
+			n_culled   += ntotal - len(tiles)
 
-			### Fill the arrays
-			index_i = 0
-			index_f = 0
-			for subbox in range(n_subboxes):
-				counter_ngal += return_dict["NGAL" + str(subbox)]
-				shell_subbox_dict = return_dict[subbox]
+			units.append({"target": "generate_shell", "shell_args": (chilow, chiupp), "chilow": chilow, "chiupp": chiupp, "redshift": redshift,
+			              "snapshot": snapshot, "label": f"shellnum={shellnum}", "shells": [(shellnum, out_file_name, None)]})
 
-				index_f = index_i + len(shell_subbox_dict["ra0"])
+		for (snapshot, redshift), shellnums in shell_groups.items():
+			groups = self.shell_runs(shellnums)
+			print(f"INFO: Single read of snapshot {snapshot} for {len(shellnums)} shells, in {len(groups)} groups of up to {self.single_read_shells} shells.")
+			for group in groups:
+				tiles, ntotal = self.replicas(self.shellwidth * group[0], self.shellwidth * (group[-1] + 1))
+				n_replicas += ntotal
+				n_culled   += ntotal - len(tiles)
+				units.append(self.group_unit(path_instance, snapshot, redshift, group))
+		return units, n_replicas, n_culled
 
-				ra0_array[index_i: index_f]  = shell_subbox_dict["ra0"]
-				dec0_array[index_i: index_f] = shell_subbox_dict["dec0"]
-				zz0_array[index_i: index_f]  = shell_subbox_dict["zz0"]
-				aux0_array[index_i: index_f] = shell_subbox_dict["aux0"]
 
-				index_i = index_f
-
-			out_file_name_tmp  = out_file_name + "_tmp"
-
-			with h5py.File(out_file_name_tmp, 'w') as out_file:
-				out_file.create_group('galaxy')
-				out_file.create_dataset('galaxy/RA',      data=ra0_array,    dtype=np.float32)
-				out_file.create_dataset('galaxy/DEC',     data=dec0_array,   dtype=np.float32)
-				out_file.create_dataset('galaxy/Z_COSMO', data=zz0_array,     dtype=np.float32)
+	def shell_runs(self, shellnums):
+		""" the increasing shellnums split into runs of consecutive shells, of at most single_read_shells shells each """
+		runs = []
+		for shellnum in shellnums:
+			if runs and shellnum == runs[-1][-1] + 1 and len(runs[-1]) < self.single_read_shells:
+				runs[-1].append(shellnum)
+			else:
+				runs.append([shellnum])
+		return runs
+
+
+	def group_unit(self, path_instance, snapshot, redshift, group):
+		""" the unit of the shells of group, all produced from a single read of the subboxes of the snapshot """
+		chilow = self.shellwidth * (group[0] + 0)
+		chiupp = self.shellwidth * (group[-1] + 1)
+		shells = [(shellnum, path_instance.output_file.format(snapshot=snapshot, shellnum=str(shellnum)), shellnum) for shellnum in group]
+		return {"target": "generate_shell_group", "shell_args": (group,), "chilow": chilow, "chiupp": chiupp, "redshift": redshift,
+		        "snapshot": snapshot, "label": f"shellnums={group[0]}-{group[-1]}", "shells": shells}
+
+
+	def plan_settings(self, snapshot, redshift, cutsky, single_read, n_subboxes):
+		""" everything the units of a plan depend on, apart from the realization """
+		return {"box_length": self.box_length, "shellwidth": self.shellwidth, "zmin": self.zmin, "zmax": self.zmax, "rotate": self.rotate,
+		        "file_camb": self.file_camb, "mock_random_ic": self.mock_random_ic, "snapshot": snapshot if cutsky else None,
+		        "redshift": redshift if cutsky else None, "cutsky": cutsky, "single_read": single_read,
+		        "single_read_shells": self.single_read_shells if single_read else None, "n_subboxes": n_subboxes}
+
+
+	def partial_settings(self, snapshot, redshift, cutsky, n_subboxes, cat_seed):
+		""" everything the shell selections of a subbox depend on, apart from the subbox and the range of the shell:
+		the settings of the plan, the rotation, the compute options and the realization """
+		settings = self.plan_settings(snapshot, redshift, cutsky, None, n_subboxes)
+		del settings["single_read"], settings["single_read_shells"]
+		settings.update({"rotation_matrix": np.asarray(self.rotation_matrix, dtype=np.float64).ravel().tolist(), "origin": list(self.origin),
+		                 "float32": self.float32, "backend": self.backend, "clight": self.clight, "cat_seed": cat_seed})
+		return settings
+
+
+	def plan_units(self, plan, path_instance, settings, done):
+		""" (units, number of replicas, number of replicas culled) of a plan, for the realization of path_instance,
+		without the shells for which done(shellnum, out_file_name) """
+		for key, value in settings.items():
+			if plan["settings"].get(key) != value:
+				print(f"ERROR: The plan {self.plan_file} was made with {key} = {plan['settings'].get(key)}, not {value}.")
+				os._exit(1)
+
+		n_replicas, n_culled = 0, 0
+		units = []
+		for entry in plan["units"]:
+			snapshot, redshift = entry["snapshot"], entry["redshift"]
+			shellnums = [shellnum for shellnum in entry["shellnums"] if not done(shellnum, path_instance.output_file.format(snapshot=snapshot, shellnum=str(shellnum)))]
+			if not shellnums:
+				continue
+			if entry["target"] == "generate_shell":
+				shellnum = shellnums[0]
+				unit = {"target": "generate_shell", "shell_args": (entry["chilow"], entry["chiupp"]), "chilow": entry["chilow"], "chiupp": entry["chiupp"],
+				        "redshift": redshift, "snapshot": snapshot, "label": entry["label"],
+				        "shells": [(shellnum, path_instance.output_file.format(snapshot=snapshot, shellnum=str(shellnum)), None)]}
+			else:
+				unit = self.group_unit(path_instance, snapshot, redshift, shellnums)
+
+			### The subboxes are submitted by their planned cost until their extent is known
+			unit["costs"] = {task["subbox"]: task["touched"] for task in entry["subboxes"] if not task.get("missing")}
+			n_replicas += entry["replicas"]
+			n_culled   += entry["culled"]
+			units.append(unit)
+		print(f"INFO: {len(units)} units of {len(plan['units'])} taken from the plan {self.plan_file}.")
+		return units, n_replicas, n_culled
+
+
+	def subbox_rows(self, infile, extents):
+		""" number of objects of a subbox, from its extent record, its raw columns or its FITS header; None if it is missing """
+		record = extents.get(infile)
+		if record is not None:
+			return record["ngal"]
+		store = self.column_store(infile)
+		if store is not None:
+			with open(os.path.join(store, "meta.json"), "r") as f:
+				return json.load(f)["nrows"]
+		if os.path.isfile(infile):
+			with fits.open(infile) as hdul:
+				return hdul[1].header["NAXIS2"]
+		return None
+
+
+	def subbox_bytes(self, infile):
+		""" number of bytes that a worker reads for infile """
+		sizes = [os.path.getsize(filename) for filename in self.input_files(infile) if os.path.isfile(filename)]
+		if not sizes and os.path.isfile(infile):
+			sizes = [os.path.getsize(infile)]
+		return sum(sizes)
+
+
+	def calibrate(self, units, path_instance, ngal=2**18):
+		""" (bytes read per second, objects times replicas per second) of a worker: the first subbox of the plan is read,
+		and a synthetic subbox of ngal objects is transformed into a shell in the middle of the plan """
+		read_rate = None
+		for unit in units[:1]:
+			infile = path_instance.input_file.format(redshift=unit["redshift"], subbox=0)
+			if os.path.isfile(infile) or self.column_store(infile) is not None:
+				nbytes = self.subbox_bytes(infile)
+				start = time.perf_counter()
+				self.obtain_data(infile, "[plan]: ")
+				read_rate = nbytes / (time.perf_counter() - start)
+
+		rng  = np.random.default_rng(0)
+		data = SubboxColumns({col: rng.uniform(0, self.box_length, size=ngal).astype(np.float32) for col in ("x", "y", "z")})
+		for col in self.columns()[3:]:
+			data[col] = rng.normal(0, 1, size=ngal).astype(np.int32 if col == "id" else np.float32)
+		chilow, chiupp = (units[len(units) // 2]["chilow"], units[len(units) // 2]["chiupp"]) if units else (0, self.shellwidth)
+		self.accumulate_shell(SubboxColumns({col: values[:16] for col, values in data.items()}), "", chilow, chiupp)
+		start = time.perf_counter()
+		self.accumulate_shell(data, "", chilow, chiupp)
+		compute_rate = ngal * len(self.replicas(chilow, chiupp)[0]) / (time.perf_counter() - start)
+		return read_rate, compute_rate
+
+
+	def write_plan(self, units, path_instance, extents, n_subboxes, nproc, settings):
+		""" Writes the plan of the units into self.plan_file: for every unit, its shells, replicas and subboxes, with the
+		objects touched (objects times replicas) and emitted, the bytes read and written and the time of every subbox,
+		and the projected wall time of the run on nproc workers. The number of replicas of a subbox is exact once its extent
+		is known (subbox_extents.json), and that of the whole box otherwise; the objects emitted are those of the mean density. """
+		read_rate, compute_rate = self.calibrate(units, path_instance)
+		bytes_per_object = 3 * 4 + 4
+		plan_units, times = [], []
+		inputs = {}                                                              # (ngal, bytes) of every subbox file, None if it is missing
+		for unit in units:
+			chilow, chiupp = unit["chilow"], unit["chiupp"]
+			tiles, ntotal = self.replicas(chilow, chiupp)
+			subboxes = []
+			for subbox in range(n_subboxes):
+				infile = path_instance.input_file.format(redshift=unit["redshift"], subbox=subbox)
+				if infile not in inputs:
+					ngal = self.subbox_rows(infile, extents)
+					inputs[infile] = None if ngal is None else (int(ngal), self.subbox_bytes(infile))
+				if inputs[infile] is None:
+					subboxes.append({"subbox": subbox, "missing": True, "ngal": 0, "replicas": 0, "touched": 0, "bytes_read": 0})
+					continue
+
+				ngal, nbytes = inputs[infile]
+				record = extents.get(infile)
+				if record is None:
+					nreplicas = len(tiles)
+				else:
+					nreplicas = 0 if record["lower"] is None else len(self.replicas(chilow, chiupp, extent=(record["lower"], record["upper"]))[0])
+				subboxes.append({"subbox": subbox, "ngal": ngal, "replicas": nreplicas, "touched": ngal * nreplicas,
+				                 "bytes_read": nbytes if nreplicas > 0 else 0})
+
+			### Objects emitted at the mean density of the boxes, shared between the subboxes that are read
+			ngal_box = sum(task["ngal"] for task in subboxes)
+			ngal_read = sum(task["ngal"] for task in subboxes if task["replicas"] > 0)
+			emitted = ngal_box / self.box_length**3 * 4. / 3. * np.pi * (chiupp**3 - chilow**3)
+			for task in subboxes:
+				task["emitted"] = int(emitted * task["ngal"] / ngal_read) if task["replicas"] > 0 and ngal_read > 0 else 0
+				task["time"] = (task["bytes_read"] / read_rate if read_rate else 0.) + task["touched"] / compute_rate
+				if task["replicas"] > 0:
+					times.append(task["time"])
+
+			plan_units.append({"target": unit["target"], "label": unit["label"], "snapshot": unit["snapshot"], "redshift": unit["redshift"],
+			                   "chilow": chilow, "chiupp": chiupp, "shellnums": [shell[0] for shell in unit["shells"]],
+			                   "replicas": ntotal, "culled": ntotal - len(tiles), "subboxes": subboxes,
+			                   "touched": sum(task["touched"] for task in subboxes), "emitted": sum(task["emitted"] for task in subboxes),
+			                   "bytes_read": sum(task["bytes_read"] for task in subboxes),
+			                   "bytes_written": bytes_per_object * sum(task["emitted"] for task in subboxes),
+			                   "time": sum(task["time"] for task in subboxes)})
+
+		### The tasks go to the first free worker, in the order of the units and largest first within a unit;
+		### there are no more workers running at once than there are cores
+		cores   = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+		workers = np.zeros(max(min(nproc, cores), 1))
+		for unit in plan_units:
+			for task in sorted(unit["subboxes"], key=lambda task: -task["time"]):
+				if task["replicas"] > 0:
+					workers[np.argmin(workers)] += task["time"]
+
+		totals = {key: sum(unit[key] for unit in plan_units) for key in ("touched", "emitted", "bytes_read", "bytes_written")}
+		totals.update(shells=sum(len(unit["shellnums"]) for unit in plan_units), units=len(plan_units), tasks=len(times),
+		              cpu_time=float(sum(times)), wall_time=float(np.max(workers)))
+		plan = {"settings": settings, "nproc": nproc, "cores": cores, "rates": {"read": read_rate, "compute": compute_rate}, "totals": totals, "units": plan_units}
+
+		plan_file_tmp = self.plan_file + f"_tmp{os.getpid()}"
+		with open(plan_file_tmp, "w") as f:
+			json.dump(plan, f, indent=1, default=lambda value: value.item())
+		os.rename(plan_file_tmp, self.plan_file)
+
+		print(f"INFO: Plan written to {self.plan_file}: {totals['shells']} shells in {totals['units']} units, {totals['tasks']} subbox tasks.")
+		missing = [infile for infile, found in inputs.items() if found is None]
+		if missing:
+			print(f"WARNING: {len(missing)} of {len(inputs)} subbox files are missing (e.g. {missing[0]}): they count for nothing in the plan.")
+		print(f"INFO: Plan: {totals['touched']:.3e} objects x replicas touched, {totals['emitted']:.3e} objects emitted, "
+		      f"{totals['bytes_read'] / 2**30:.2f} GiB read, {totals['bytes_written'] / 2**30:.2f} GiB written.")
+		read_info = f"{read_rate / 2**20:.1f} MiB/s read" if read_rate else "no input file to time the reads"
+		print(f"INFO: Plan: {compute_rate:.3e} objects x replicas per second, {read_info}; "
+		      f"projected {totals['cpu_time']:.1f} s of work, {totals['wall_time']:.1f} s of wall time on {nproc} workers ({cores} cores).")
+
+
+	def generate_shells(self, path_instance, snapshot=None, redshift=None, cutsky=True, nproc=5, n_subboxes=27, cat_seed=None, single_read=None):
+		""" With single_read=True (by default, the single_read entry of the configuration or the --single_read option),
+		each subbox is read once for every run of up to single_read_shells consecutive shells of a snapshot,
+		and all the shells of the run are produced from a single pass.
+		With the --mpi option, the work is spread over the MPI ranks instead of nproc local processes.
+		With --dry_run, the plan of the run is written into the --plan file instead; without it, the units of an existing
+		plan are run, for the realization of path_instance, instead of being worked out again. """
+		if single_read is None:
+			single_read = self.single_read
+		extents = SubboxExtents(path_instance.shells_out_path + "/subbox_extents.json")
+		if self.shell_layout == "store":
+			self.store = ShellStore(path_instance.store_file)
+			stored = self.store.shellnums()
+		if self.checkpoint_partials:
+			self.checkpoint = Checkpoint(path_instance.shells_out_path + "/checkpoint", self.partial_settings(snapshot, redshift, cutsky, n_subboxes, cat_seed))
+
+		def done(shellnum, out_file_name):
+			if self.dry_run:
+				return False
+			return (shellnum in stored) if self.store is not None else os.path.isfile(out_file_name)
+
+		def prepare():
+			settings = self.plan_settings(snapshot, redshift, cutsky, single_read, n_subboxes)
+			if self.plan_file is not None and not self.dry_run:
+				if not os.path.isfile(self.plan_file):
+					print(f"ERROR: There is no plan {self.plan_file}. You should write it first with --dry_run.")
+					os._exit(1)
+				with open(self.plan_file, "r") as f:
+					units, n_replicas, n_culled = self.plan_units(json.load(f), path_instance, settings, done)
+			else:
+				units, n_replicas, n_culled = self.shell_units(path_instance, snapshot, redshift, cutsky, single_read, done)
+			if self.checkpoint is not None and not self.dry_run:
+				self.checkpoint.sweep()
+				for unit in units:
+					unit["resumed"] = self.resumed_subboxes(unit, path_instance, n_subboxes)
+			return settings, units, n_replicas, n_culled
+
+		### The shells already done and the partials found are decided once, before any of them is written:
+		### under MPI, by rank 0 for all the ranks, so that they all make the same assignment
+		if self.mpi:
+			from mpi4py import MPI
+			comm = MPI.COMM_WORLD
+			prepared = prepare() if comm.Get_rank() == 0 else None
+			settings, units, n_replicas, n_culled = comm.bcast(prepared, root=0)
+			if self.dry_run and comm.Get_rank() != 0:
+				return
+		else:
+			settings, units, n_replicas, n_culled = prepare()
 
-				if self.mock_random_ic == "mock":
-					out_file.create_dataset('galaxy/Z_RSD',   data=aux0_array, dtype=np.float32)
-				elif self.mock_random_ic == "random":
-					out_file.create_dataset('galaxy/ID',      data=aux0_array, dtype=np.int32)
-				elif self.mock_random_ic == "ic":
-					out_file.create_dataset('galaxy/ONEplusDELTA', data=1 + aux0_array, dtype=np.float32)
+		if self.dry_run:
+			if self.plan_file is None:
+				print("ERROR: --dry_run needs the --plan file to write the plan into.")
+				os._exit(1)
+			self.write_plan(units, path_instance, extents, n_subboxes, nproc, settings)
+			return
 
-				out_file.attrs['NGAL']     = counter_ngal
-				out_file.attrs['SHELLNUM'] = shellnum
-				out_file.attrs['SNAPSHOT'] = snapshot
-				out_file.attrs['CAT_SEED'] = cat_seed
-				out_file.attrs['BOX_LENGTH'] = self.box_length
+		if self.shell_filters.chunked:
+			print(f"INFO: Shell columns written {self.shell_filters}.")
 
-			os.rename(out_file_name_tmp, out_file_name)
+		if self.mpi:
+			self.run_units_mpi(units, path_instance, extents, n_subboxes, cat_seed)
+		else:
+			nswept = SharedShells.sweep()
+			if nswept:
+				print(f"WARNING: {nswept} shared memory segments left behind by runs that died removed from {SharedShells.directory}.")
+			pool = WorkerPool(self, nproc)
+			try:
+				self.run_units(units, path_instance, extents, pool, n_subboxes, cat_seed)
+			finally:
+				pool.shutdown()
+
+		print(f"INFO: Replica culling: {n_culled} of {n_replicas} replicas culled.")
@@ -36,7 +36,7 @@ def LC_ABACUS(args, galtype=None):
 	# survey_geometry_instance.shell_series(path_instance, todo=3)
 
 	out_fits = path_instance.dir_out + f"/LightCone/{galtype}_LC_AbacusSummit_base_c000_ph{phase}.fits"
-	stack_shells(survey_geometry_instance, inpath=path_instance.shells_out_path, out_file=out_fits, mock_random_ic="mock", ngc_sgc_tot="TOT")
+	stack_shells(survey_geometry_instance, inpath=path_instance.shells_path, out_file=out_fits, mock_random_ic="mock", ngc_sgc_tot="TOT")
 
 
 def cutsky_ic_ABACUS(args, galtype=None, redshift=None, snapshot=None):
@@ -64,7 +64,7 @@ def cutsky_ic_ABACUS(args, galtype=None, redshift=None, snapshot=None):
 		# survey_geometry_instance.shell(path_instance, nproc=64, todo=3)
 		
 		# out_fits = path_instance.dir_out + f"/{redshift}/fits/cutsky_{galtype}_{redshift}_{in_fol_temp}{phase}.fits"
-		# stack_shells(survey_geometry_instance, inpath=path_instance.shells_out_path, out_file=out_fits, mock_random_ic="mock", ngc_sgc_tot="TOT", seed=i)
+		# stack_shells(survey_geometry_instance, inpath=path_instance.shells_path, out_file=out_fits, mock_random_ic="mock", ngc_sgc_tot="TOT", seed=i)
 
 def cutsky_ABACUS(args, galtype=None, gal_in_name=None, redshift=None, snapshot=None):
 	in_fol_temp = "AbacusSummit_base_c000_ph"
@@ -92,7 +92,7 @@ def cutsky_ABACUS(args, galtype=None, gal_in_name=None, redshift=None, snapshot=
 		# survey_geometry_instance.shell(path_instance, nproc=64, todo=3)
 		
 		# out_fits = path_instance.dir_out + f"/{redshift}/fits/cutsky_{galtype}_{redshift}_{in_fol_temp}{phase}.fits"
-		# stack_shells(survey_geometry_instance, inpath=path_instance.shells_out_path, out_file=out_fits, mock_random_ic="mock", ngc_sgc_tot="TOT", seed=i)
+		# stack_shells(survey_geometry_instance, inpath=path_instance.shells_path, out_file=out_fits, mock_random_ic="mock", ngc_sgc_tot="TOT", seed=i)
 
 
 def cutsky_EZmock(args, galtype=None, redshift=None, in_fol_temp=None, box_size=6):
@@ -124,14 +124,14 @@ def cutsky_EZmock(args, galtype=None, redshift=None, in_fol_temp=None, box_size=
 			# survey_geometry_instance.shell(path_instance, nproc=64)
 			# survey_geometry_instance.shell_series(path_instance)
 			out_fits = path_instance.dir_out + redshift + "/cutsky_" + galtype + "_" + redshift + "_" + in_fol_temp + "{phase}"
-			# stack_shells(survey_geometry_instance, inpath=path_instance.shells_out_path, out_file=out_fits, mock_random_ic="mock", ngc_sgc_tot="NGC_SGC", seed=i, max_seed=2000)
-			stack_shells(survey_geometry_instance, inpath=path_instance.shells_out_path, out_file=out_fits, mock_random_ic="mock", ngc_sgc_tot="TOT", seed=i)
+			# stack_shells(survey_geometry_instance, inpath=path_instance.shells_path, out_file=out_fits, mock_random_ic="mock", ngc_sgc_tot="NGC_SGC", seed=i, max_seed=2000)
+			stack_shells(survey_geometry_instance, inpath=path_instance.shells_path, out_file=out_fits, mock_random_ic="mock", ngc_sgc_tot="TOT", seed=i)
 		
 		else:
 			# lightcone_instance.generate_shells(path_instance, snapshot="", redshift=redshift, cutsky=True, nproc=16, n_subboxes=64, cat_seed=i)
 			# survey_geometry_instance.shell(path_instance, nproc=64)
 			out_fits = path_instance.dir_out + redshift + "/cutsky_" + galtype + "_" + redshift + "_" + in_fol_temp + f"{phase}.fits"
-			stack_shells(survey_geometry_instance, inpath=path_instance.shells_out_path, out_file=out_fits, mock_random_ic="mock", ngc_sgc_tot="TOT", seed=i)
+			stack_shells(survey_geometry_instance, inpath=path_instance.shells_path, out_file=out_fits, mock_random_ic="mock", ngc_sgc_tot="TOT", seed=i)
 
 
 def random_EZmock(args, galtype=None, in_fol_temp=None):
@@ -160,7 +160,7 @@ def random_EZmock(args, galtype=None, in_fol_temp=None):
 		survey_geometry_instance.shell(path_instance, nproc=64)
 
 		out_fits = path_instance.dir_out + "/cutsky_" + galtype + "_" + in_fol_temp + "{phase}"
-		stack_shells(survey_geometry_instance, inpath=path_instance.shells_out_path, out_file=out_fits, mock_random_ic="random", ngc_sgc_tot="NGC_SGC", seed=i * 100, max_seed=5000, min_seed=100)
+		stack_shells(survey_geometry_instance, inpath=path_instance.shells_path, out_file=out_fits, mock_random_ic="random", ngc_sgc_tot="NGC_SGC", seed=i * 100, max_seed=5000, min_seed=100)
 
 
 def cutsky_small_ABACUS(args, galtype=None, gal_in_name=None, redshift=None, snapshot=None):
@@ -190,7 +190,7 @@ def cutsky_small_ABACUS(args, galtype=None, gal_in_name=None, redshift=None, sna
 	survey_geometry_instance.shell(path_instance, nproc=8, todo=3)
 	
 	out_fits = path_instance.dir_out + f"/{redshift}/fits/cutsky_{galtype}_{redshift}_{in_fol_temp}{phase}.fits"
-	stack_shells(survey_geometry_instance, inpath=path_instance.shells_out_path, out_file=out_fits, mock_random_ic="mock", ngc_sgc_tot="TOT", seed=i)
+	stack_shells(survey_geometry_instance, inpath=path_instance.shells_path, out_file=out_fits, mock_random_ic="mock", ngc_sgc_tot="TOT", seed=i)
 
 
 def cutsky_random_small_ABACUS(args, galtype=None, gal_in_name=None, redshift=None, snapshot=None):
@@ -220,7 +220,7 @@ def cutsky_random_small_ABACUS(args, galtype=None, gal_in_name=None, redshift=No
 	# survey_geometry_instance.shell(path_instance, nproc=8, todo=3)
 	
 	out_fits = path_instance.dir_out + f"/{redshift}/fits/cutsky_{galtype}_{redshift}{in_fol_temp}{phase}.fits"
-	stack_shells(survey_geometry_instance, inpath=path_instance.shells_out_path, out_file=out_fits, mock_random_ic="random", ngc_sgc_tot="TOT", seed=i)
+	stack_shells(survey_geometry_instance, inpath=path_instance.shells_path, out_file=out_fits, mock_random_ic="random", ngc_sgc_tot="TOT", seed=i)
 
 
 def main():
@@ -233,6 +233,10 @@ def main():
 	parser.add_argument("--phase", type=int, help="phase of the catalog")
 	parser.add_argument("--ngc_sgc", type=str, help="NGC or SGC preferred rotation")
 	parser.add_argument("--mock_random_ic", type=str, help="mock, random or ic")
+	parser.add_argument("--mpi", action="store_true", help="distribute the shells over the MPI ranks (run with mpirun)")
+	parser.add_argument("--single_read", action="store_true", help="read every subbox once for several consecutive shells (same as single_read in [sim])")
+	parser.add_argument("--plan", type=str, help="plan of the shells: written by --dry_run, followed by the runs without it")
+	parser.add_argument("--dry_run", action="store_true", help="write the plan of the shells, with their expected work and cost, and stop")
 
 	args = parser.parse_args()
 
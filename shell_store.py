@@ -0,0 +1,177 @@
+import os
+import glob
+import errno
+import json
+import fcntl
+from contextlib import contextmanager
+
+import numpy as np
+import h5py
+
+
+class ShellFilters():
+    """ HDF5 storage of the shell columns: contiguous, or chunked with shuffle and a compressor.
+
+    compression is none, gzip, lzf or blosc (blosc:<cname> for a given blosc compressor, with hdf5plugin);
+    level is the compression level of gzip (default 4) and blosc (default 5), and chunk_size the number of rows of a chunk.
+    """
+    def __init__(self, compression="none", level=None, shuffle=True, chunk_size=2**18):
+        self.compression = compression
+        self.level       = level
+        self.shuffle     = shuffle
+        self.chunk_size  = chunk_size
+
+        if compression.split(":")[0] not in ("none", "gzip", "lzf", "blosc"):
+            print(f"ERROR: Unknown hdf5_compression {compression}. You should choose between: none, gzip, lzf or blosc.")
+            os._exit(1)
+        if compression.startswith("blosc"):
+            try:
+                import hdf5plugin
+            except ImportError:
+                print("WARNING: hdf5plugin is not installed, falling back to gzip compression of the shells.")
+                self.compression, self.level = "gzip", None
+        if self.level is None:
+            self.level = {"gzip": 4, "blosc": 5}.get(self.compression.split(":")[0])
+
+    @classmethod
+    def from_config(cls, config):
+        """ from the hdf5_compression, hdf5_compression_level, hdf5_shuffle and hdf5_chunk_size entries of the [sim] section """
+        level = config.getint('sim', 'hdf5_compression_level', fallback=None)
+        return cls(compression=config.get('sim', 'hdf5_compression', fallback='none'), level=level,
+                   shuffle=config.getboolean('sim', 'hdf5_shuffle', fallback=True), chunk_size=config.getint('sim', 'hdf5_chunk_size', fallback=2**18))
+
+    @property
+    def chunked(self):
+        return self.compression != "none"
+
+    def options(self, nrows):
+        """ keyword arguments of h5py's create_dataset for a column of nrows rows """
+        if not self.chunked or nrows == 0:
+            return {}
+
+        options = {"chunks": (min(self.chunk_size, nrows),)}
+        if self.compression == "gzip":
+            options.update(compression="gzip", compression_opts=self.level, shuffle=self.shuffle)
+        elif self.compression == "lzf":
+            options.update(compression="lzf", shuffle=self.shuffle)
+        else:
+            import hdf5plugin
+            cname = self.compression.split(":")[1] if ":" in self.compression else "lz4"
+            shuffle = hdf5plugin.Blosc.SHUFFLE if self.shuffle else hdf5plugin.Blosc.NOSHUFFLE
+            options.update(hdf5plugin.Blosc(cname=cname, clevel=self.level, shuffle=shuffle))
+        return options
+
+    def __str__(self):
+        if not self.chunked:
+            return "contiguous"
+        level = "" if self.level is None else f" level {self.level}"
+        return f"{self.compression}{level}{' + shuffle' if self.shuffle else ''}, chunks of {self.chunk_size} rows"
+
+
+class ShellStore():
+    """ All the shells of a realization in a single HDF5 file, instead of a file per shell.
+
+    Every shell is a group shell_<shellnum> laid out as a shell file: a galaxy group with the columns and the
+    NGAL, SHELLNUM, SNAPSHOT, CAT_SEED and BOX_LENGTH attributes. The index dataset has a row per complete shell,
+    with its number, number of rows, NGAL and attributes (as JSON); a shell is added to it once it is written.
+    Writers of all the processes take an exclusive lock on filename.lock, readers a shared one: with flock, or with
+    lockf on file systems without flock (Lustre mounted with localflock), which only locks between processes.
+    """
+    index_dtype = [("SHELLNUM", "i4"), ("NROWS", "i8"), ("NGAL", "i8"), ("ATTRS", h5py.string_dtype())]
+
+    def __init__(self, filename):
+        self.filename  = filename
+        self.lock_file = filename + ".lock"
+
+    @contextmanager
+    def open(self, mode="r"):
+        """ the h5py.File of the store, opened with mode ("r" or "a") while holding the lock """
+        with open(self.lock_file, "a+") as lock:
+            unlock = self.lock(lock, fcntl.LOCK_SH if mode == "r" else fcntl.LOCK_EX)
+            try:
+                with h5py.File(self.filename, mode) as f:
+                    yield f
+            finally:
+                unlock()
+
+    def lock(self, lock, operation):
+        """ takes the lock on the open lock file, and returns the function that releases it """
+        for take in (fcntl.flock, fcntl.lockf):
+            try:
+                take(lock, operation)
+                return lambda: take(lock, fcntl.LOCK_UN)
+            except OSError as error:
+                if error.errno not in (errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+        print(f"ERROR: The file system of {self.lock_file} supports neither flock nor lockf locks. "
+              f"On Lustre, it has to be mounted with the flock (or localflock, for a single node) option.")
+        os._exit(1)
+
+    @staticmethod
+    def group(shellnum):
+        """ name of the group of shell shellnum """
+        return f"shell_{shellnum}"
+
+    def index(self):
+        """ the index of the complete shells, ordered by shell number """
+        if not os.path.isfile(self.filename):
+            return np.zeros(0, dtype=self.index_dtype)
+        with self.open("r") as f:
+            if "index" not in f:
+                return np.zeros(0, dtype=self.index_dtype)
+            index = f["index"][()]
+        return np.sort(index, order="SHELLNUM")
+
+    def shellnums(self):
+        return set(int(shellnum) for shellnum in self.index()["SHELLNUM"])
+
+    def shells(self):
+        """ (shellnum, group) of the complete shells, in order, read under a shared lock """
+        with self.open("r") as f:
+            for shellnum in np.sort(f["index"].fields("SHELLNUM")[()]) if "index" in f else []:
+                yield int(shellnum), f[self.group(shellnum)]
+
+    def write_shell(self, shellnum, fill):
+        """ writes shell shellnum, with fill(group) filling its group, and adds it to the index.
+        A group left over by an interrupted write, or an earlier version of the shell, is replaced. """
+        name = self.group(shellnum)
+        with self.open("a") as f:
+            if "index" not in f:
+                f.create_dataset("index", shape=(0,), maxshape=(None,), dtype=self.index_dtype)
+            index = f["index"]
+            if shellnum in index.fields("SHELLNUM")[()]:
+                rows = index[()]
+                rows = rows[rows["SHELLNUM"] != shellnum]
+                index.resize((len(rows),))
+                index[...] = rows
+            if name in f:
+                del f[name]
+
+            group = f.create_group(name)
+            fill(group)
+            attrs = {key: value.item() if hasattr(value, "item") else value for key, value in group.attrs.items()}
+            row = np.array([(shellnum, len(group["galaxy/RA"]), attrs.get("NGAL", 0), json.dumps(attrs))], dtype=self.index_dtype)
+
+            index.resize((len(index) + 1,))
+            index[-1] = row[0]
+            f.flush()
+
+
+def list_shells(inpath):
+    """ the shell files of the directory inpath, sorted, or the groups of the complete shells of the store inpath """
+    if os.path.isfile(inpath):
+        return [ShellStore.group(shellnum) for shellnum in sorted(ShellStore(inpath).shellnums())]
+    return sorted(glob.glob(inpath + "/*hdf5"))
+
+
+def iterate_shells(inpath):
+    """ (name, shell) of the shells of inpath, a directory of shell files or a shell store. shell is the h5py
+    File of a shell file, or the group of a shell of the store; both have the galaxy group and the attributes. """
+    if os.path.isfile(inpath):
+        for shellnum, group in ShellStore(inpath).shells():
+            yield ShellStore.group(shellnum), group
+        return
+
+    for file_ in list_shells(inpath):
+        with h5py.File(file_, "r") as f:
+            yield file_, f
@@ -1,11 +1,10 @@
 import os
-import glob
 import numpy as np
-import h5py
 import fitsio
 
 from apply_survey_geometry import mask
 from redshift_error_QSO import sample_redshift_error
+from shell_store import list_shells, iterate_shells
 
 
 def count_aux(status_tmp, ra_tmp):
@@ -22,15 +21,12 @@ def count_aux(status_tmp, ra_tmp):
     return idx_Y5_TOT, idx_Y5_NGC, idx_Y5_SGC
 
 
-def count(files):
-    print(len(files))
-
+def count(inpath):
     counter_TOT = 0
     counter_NGC = 0
     counter_SGC = 0
 
-    for i, file_ in enumerate(files):
-        f = h5py.File(file_, 'r')
+    for name, f in iterate_shells(inpath):
         data = f['galaxy']
         ra_tmp      = data['RA'][()]
         status_tmp  = data['STATUS'][()]
@@ -40,7 +36,6 @@ def count(files):
         counter_SGC = counter_SGC + len(status_tmp[idx_Y5_SGC])
         counter_TOT = counter_TOT + len(status_tmp[idx_Y5_TOT])
 
-        f.close()
     return counter_TOT, counter_NGC, counter_SGC
 
 
@@ -74,11 +69,11 @@ def fill_array(output_data_array, input_data_array, columns, idx, index_i, n_mea
 
 
 def stack_shells(survey_geometry_instance, inpath="test", out_file="test", seed=0, max_seed=0, min_seed=1, mock_random_ic=None, ngc_sgc_tot=None):
-    files = glob.glob(inpath + "/*hdf5")
-    files.sort()
+    """ inpath is the directory of the shell files, or the shell store of the realization """
+    files = list_shells(inpath)
 
     print("INFO: The number of shells: ", len(files))
-    counter_TOT, counter_NGC, counter_SGC = count(files)
+    counter_TOT, counter_NGC, counter_SGC = count(inpath)
     print(f"The number of tracers: TOT={counter_TOT}; NGC={counter_NGC}; SGC={counter_SGC}")
 
     general_columns = [('RA', 'f4'), ('DEC', 'f4'), ('Z_COSMO', 'f4'), ('STATUS', 'i4'), ('RAW_NZ', 'f4'), ('RAN_NUM_0_1', 'f4'),('NZ', 'f4')]
@@ -112,9 +107,8 @@ def stack_shells(survey_geometry_instance, inpath="test", out_file="test", seed=
     else:
         print("ERROR: Choose NGC_SGC or TOT for ngc_sgc_tot variable")
 
-    for i, file_ in enumerate(files):
+    for i, (file_, f) in enumerate(iterate_shells(inpath)):
         print(f"File {i + 1}/{len(files)}")
-        f = h5py.File(file_, 'r')
         data = f['galaxy']
         ngalbox    = f.attrs["NGAL"]
         n_mean = ngalbox / (survey_geometry_instance.box_length ** 3)
@@ -131,8 +125,6 @@ def stack_shells(survey_geometry_instance, inpath="test", out_file="test", seed=
             index_i_SGC = fill_array(data_fits_SGC, data, all_columns, idx_Y5_SGC, index_i_SGC, n_mean, survey_geometry_instance)
 
 
-        f.close()
-
     hdict = {'SV3_AREA': 207.5, 'Y5_TOT_AREA':14850.4, 'Y5_SGC_AREA':4666.5, 'Y5_NGC_AREA':10183.9}
 
     if ngc_sgc_tot == "TOT":